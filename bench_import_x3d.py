@@ -0,0 +1,789 @@
+# For license and additional information about this code, please refer to https://github.com/niaid/3Dmodel_scripts/blob/master/README.md
+# This script runs in plain Python 3, no Blender needed.
+# It times the parser half of import_x3d.py on synthetic files shaped like our Chimera exports.
+
+import os, sys, json, getopt, time, shutil, tempfile, tracemalloc
+import numpy as np
+from math import sin, cos, pi
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import import_x3d
+
+
+def usage():
+    print ("")
+    print ("bench_import_x3d.py: a Python script to benchmark the X3D/VRML parser")
+    print ("")
+    print ("""Usage: python bench_import_x3d.py [-n <vertex_count>] [--no-legacy] [--save <JSON_file>]""")
+    print ("""                                   [--baseline <JSON_file>] [--tolerance <fraction>] [<WRL_or_X3D_file> ...]""")
+    print ("")
+    print ("    -n int             Vertex count of the generated surface and ribbons and atom")
+    print ("                       count of the CPK models, a tenth of it for the number of")
+    print ("                       shapes in the generated scenes, ten times it for the pixels")
+    print ("                       of the PixelTexture (default 20000)")
+    print ("    --no-legacy        Skip the original vrmlFormat, it is quadratic on large files")
+    print ("    --save file        Write the time and peak memory of every stage to a JSON baseline")
+    print ("    --baseline file    Compare with a saved baseline, exit with 1 if a stage got slower")
+    print ("                       or uses more memory than the tolerance allows")
+    print ("    --tolerance float  Allowed growth over the baseline (default 0.25, 25%)")
+    print ("")
+    print ("Each file is also parsed to time the field lookups done while importing it,")
+    print ("the splitting of IndexedFaceSet indices into faces (try -n 1000000)")
+    print ("and the decoding of PixelTextures.")
+    print ("X3D files are parsed, and read with minidom to compare the memory used.")
+    print ("")
+
+
+# =============================== Synthetic scenes
+
+def write_surface_wrl(path, vertex_count):
+    # One big IndexedFaceSet, like a Chimera "export format vrml" of a molecular surface
+    f = open(path, 'w')
+    f.write('#VRML V2.0 utf8\n')
+    f.write('# Created by synthetic generator\n')
+    f.write('Transform {\n children [\n  Shape {\n')
+    f.write('   appearance Appearance {\n    material Material {\n')
+    f.write('     diffuseColor 0.8 0.4 0.2\n     specularColor 1 1 1\n     shininess 0.25\n    }\n   }\n')
+    f.write('   geometry IndexedFaceSet {\n    coord Coordinate {\n     point [\n')
+    for i in range(vertex_count):
+        f.write('      %.4f %.4f %.4f,\n' % (i * 0.001, (i * 7 % 101) * 0.01, (i * 13 % 97) * -0.01))
+    f.write('     ]\n    }\n    color Color {\n     color [\n')
+    for i in range(vertex_count):
+        f.write('      %.3f %.3f %.3f,\n' % ((i % 10) * 0.1, 0.5, 1.0 - (i % 10) * 0.1))
+    f.write('     ]\n    }\n    coordIndex [\n')
+    for i in range(vertex_count - 2):
+        f.write('      %d,%d,%d,-1,\n' % (i, i + 1, i + 2))
+    f.write('    ]\n   }\n  }\n ]\n}\n')
+    f.close()
+
+
+def write_shapes_wrl(path, shape_count):
+    # Many small textured shapes, every one of them has quoted strings
+    f = open(path, 'w')
+    f.write('#VRML V2.0 utf8\n')
+    for i in range(shape_count):
+        f.write('DEF S%d Transform {\n translation %d 0 0\n children [\n  Shape {\n' % (i, i))
+        f.write('   appearance Appearance {\n    material Material {\n')
+        f.write('     ambientIntensity 0.3 diffuseColor 1 0 0 emissiveColor 0 0 0\n')
+        f.write('     specularColor 1 1 1 shininess 0.25 transparency 0\n    }\n')
+        f.write('    texture ImageTexture { url "textures/atom_%d.png" }  # colored by element\n   }\n' % (i % 8))
+        f.write('   geometry Sphere { radius 1.5 }\n  }\n ]\n}\n')
+    f.close()
+
+
+def write_protos_wrl(path, shape_count):
+    # Many instances of one PROTO, every field of the body goes through IS
+    f = open(path, 'w')
+    f.write('#VRML V2.0 utf8\n')
+    f.write('PROTO Atom [\n field SFVec3f position 0 0 0\n field SFColor atomColor 1 1 1\n field SFFloat atomRadius 1\n] {\n')
+    f.write(' Transform {\n  translation IS position\n  children [\n   Shape {\n')
+    f.write('    appearance Appearance { material Material { diffuseColor IS atomColor } }\n')
+    f.write('    geometry Sphere { radius IS atomRadius }\n   }\n  ]\n }\n}\n')
+    for i in range(shape_count):
+        f.write('Atom { position %d 0 0 atomColor 0 %.2f 1 atomRadius %.1f }\n' % (i, (i % 10) * 0.1, 1.0 + (i % 3) * 0.5))
+    f.close()
+
+
+def write_cpk_wrl(path, atom_count):
+    # A space filling (CPK) model, one sphere per atom colored and sized by element
+    elements = [((0.5, 0.5, 0.5), 1.7), ((1, 0, 0), 1.52), ((0, 0, 1), 1.55), ((1, 1, 0), 1.8), ((1, 1, 1), 1.1)]
+    f = open(path, 'w')
+    f.write('#VRML V2.0 utf8\n')
+    for i in range(atom_count):
+        color, radius = elements[i * 7 % len(elements)]
+        f.write('Transform {\n translation %.3f %.3f %.3f\n children [\n  Shape {\n' % (i % 37 * 1.5, i // 37 % 29 * 1.5, i // 1073 * 1.5))
+        f.write('   appearance Appearance { material Material { diffuseColor %g %g %g } }\n' % color)
+        f.write('   geometry Sphere { radius %g }\n  }\n ]\n}\n' % radius)
+    f.close()
+
+
+def write_surface_x3d(path, vertex_count):
+    # One big IndexedFaceSet as X3D, the arrays are long attributes
+    f = open(path, 'w')
+    f.write('<?xml version="1.0" encoding="UTF-8"?>\n<X3D profile="Immersive" version="3.0">\n <Scene>\n')
+    f.write('  <Shape>\n   <Appearance><Material diffuseColor="0.8 0.4 0.2"/></Appearance>\n')
+    f.write('   <IndexedFaceSet coordIndex="')
+    f.write(' '.join(['%d %d %d -1' % (i, i + 1, i + 2) for i in range(vertex_count - 2)]))
+    f.write('">\n    <Coordinate point="')
+    f.write(', '.join(['%.4f %.4f %.4f' % (i * 0.001, (i * 7 % 101) * 0.01, (i * 13 % 97) * -0.01) for i in range(vertex_count)]))
+    f.write('"/>\n    <Color color="')
+    f.write(', '.join(['%.3f 0.5 %.3f' % ((i % 10) * 0.1, 1.0 - (i % 10) * 0.1) for i in range(vertex_count)]))
+    f.write('"/>\n   </IndexedFaceSet>\n  </Shape>\n </Scene>\n</X3D>\n')
+    f.close()
+
+
+def write_shapes_x3d(path, shape_count):
+    # The same kind of scene as X3D, lots of small elements
+    f = open(path, 'w')
+    f.write('<?xml version="1.0" encoding="UTF-8"?>\n<X3D profile="Immersive" version="3.0">\n <Scene>\n')
+    for i in range(shape_count):
+        f.write('  <Transform DEF="S%d" translation="%d 0 0">\n   <Shape>\n    <Appearance>\n' % (i, i))
+        f.write('     <Material ambientIntensity="0.3" diffuseColor="1 0 0" specularColor="1 1 1" shininess="0.25"/>\n')
+        f.write('     <ImageTexture url=\'"textures/atom_%d.png"\'/>\n    </Appearance>\n' % (i % 8))
+        f.write('    <Sphere radius="1.5" subdivision="24"/>\n   </Shape>\n  </Transform>\n')
+        if i % 10 == 9:
+            f.write('  <!-- %d shapes -->\n  <Transform USE="S%d"/>\n' % (i + 1, i))
+    f.write(' </Scene>\n</X3D>\n')
+    f.close()
+
+
+def write_ribbon_wrl(path, vertex_count):
+    # Chimera ribbons, a tube per chain segment with a color and normal per vertex
+    sides = 8
+    rings = 40  # 10 residues of 4 spline points each
+    f = open(path, 'w')
+    f.write('#VRML V2.0 utf8\n')
+    for segment in range(max(1, vertex_count // (sides * rings))):
+        color = ((segment % 3) * 0.4, 0.6, 1.0 - (segment % 3) * 0.4)
+        f.write('Transform {\n translation 0 0 %d\n children [\n  Shape {\n' % segment)
+        f.write('   appearance Appearance { material Material { } }\n')
+        f.write('   geometry IndexedFaceSet {\n    solid TRUE\n    creaseAngle 1.5\n')
+        f.write('    coord Coordinate {\n     point [\n')
+        for r in range(rings):
+            # Along a helix
+            cx, cy, cz = 2.3 * cos(r * 0.4), 2.3 * sin(r * 0.4), r * 0.375
+            for i in range(sides):
+                a = i * 2 * pi / sides
+                f.write('      %.3f %.3f %.3f,\n' % (cx + 0.6 * cos(a), cy + 0.25 * sin(a), cz))
+        f.write('     ]\n    }\n    normal Normal {\n     vector [\n')
+        for r in range(rings):
+            for i in range(sides):
+                a = i * 2 * pi / sides
+                f.write('      %.3f %.3f 0,\n' % (cos(a), sin(a)))
+        f.write('     ]\n    }\n    color Color {\n     color [\n')
+        for r in range(rings * sides):
+            f.write('      %.3f %.3f %.3f,\n' % color)
+        f.write('     ]\n    }\n    coordIndex [\n')
+        for r in range(rings - 1):
+            for i in range(sides):
+                a, b = r * sides + i, r * sides + (i + 1) % sides
+                f.write('      %d,%d,%d,-1,%d,%d,%d,-1,\n' % (a, b, b + sides, a, b + sides, a + sides))
+        f.write('    ]\n   }\n  }\n ]\n}\n')
+    f.close()
+
+
+def write_defuse_wrl(path, shape_count):
+    # A few DEF'd appearances and geometries, everything else is a USE of them
+    f = open(path, 'w')
+    f.write('#VRML V2.0 utf8\n')
+    f.write('Transform {\n children [\n  Shape {\n')
+    f.write('   appearance DEF A0 Appearance { material Material { diffuseColor 1 0 0 } }\n')
+    f.write('   geometry DEF G0 Sphere { radius 1.5 }\n  }\n')
+    f.write('  Shape {\n   appearance DEF A1 Appearance { material Material { diffuseColor 0 0 1 } }\n')
+    f.write('   geometry DEF G1 Cylinder { radius 0.2 height 1.4 }\n  }\n ]\n}\n')
+    f.write('DEF PAIR Group {\n children [\n  Shape { appearance USE A0 geometry USE G0 }\n')
+    f.write('  Transform {\n   translation 0 1 0\n   children [\n    Shape { appearance USE A1 geometry USE G1 }\n   ]\n  }\n ]\n}\n')
+    for i in range(shape_count):
+        f.write('Transform {\n translation %d %d 0\n children [\n' % (i % 100 * 3, i // 100 * 3))
+        if i % 2:
+            f.write('  USE PAIR\n ]\n}\n')
+        else:
+            f.write('  Shape {\n   appearance USE A%d\n   geometry USE G%d\n  }\n ]\n}\n' % (i % 4 // 2, i % 4 // 2))
+    f.close()
+
+
+def write_inline_wrl(path, atom_count, depth=3, fanout=4):
+    # Files that Inline others, CPK models in the files at the bottom
+    def write_level(path, level):
+        if level == depth:
+            write_cpk_wrl(path, max(1, atom_count // fanout ** depth))
+            return
+        name = os.path.splitext(os.path.basename(path))[0]
+        f = open(path, 'w')
+        f.write('#VRML V2.0 utf8\n')
+        for i in range(fanout):
+            child = '%s_%d.wrl' % (name, i)
+            f.write('Transform {\n translation %d 0 0\n children [\n  Inline { url "%s" }\n ]\n}\n' % (i * 60 * fanout ** (depth - level - 1), child))
+            write_level(os.path.join(os.path.dirname(path), child), level + 1)
+        f.close()
+
+    write_level(path, 0)
+
+
+def write_pixels_wrl(path, pixel_count):
+    # A square RGBA PixelTexture on a Box, shared by a USE
+    side = max(1, int(pixel_count ** 0.5))
+    f = open(path, 'w')
+    f.write('#VRML V2.0 utf8\n')
+    f.write('Shape {\n appearance Appearance {\n  texture DEF PIXELS PixelTexture {\n')
+    f.write('   image [ %d %d 4\n' % (side, side))
+    for y in range(side):
+        row = ['%d' % (((x * 255 // side) << 24) | ((y * 255 // side) << 16) | (((x + y) & 0xff) << 8) | 0xff)
+               for x in range(side)]
+        for i in range(0, side, 8):
+            f.write('    %s\n' % ' '.join(row[i:i + 8]))
+    f.write('   ]\n  }\n }\n geometry Box { }\n}\n')
+    f.write('Transform {\n translation 3 0 0\n children [\n')
+    f.write('  Shape { appearance Appearance { texture USE PIXELS } geometry Box { } }\n ]\n}\n')
+    f.close()
+
+
+# =============================== Reference implementation
+
+def vrmlFormat_legacy(data):
+    """
+    vrmlFormat as it was before vrmlTokenize, kept for comparison.
+    """
+    def strip_comment(l):
+        l = l.strip()
+
+        if l.startswith('#'):
+            return ''
+
+        i = l.find('#')
+
+        if i == -1:
+            return l
+
+        j = l.find('"')
+
+        if j == -1:
+            return l[:i].strip()
+
+        q = False
+        for i, c in enumerate(l):
+            if c == '"':
+                q = not q
+
+            elif c == '#':
+                if q is False:
+                    return l[:i - 1]
+
+        return l
+
+    data = '\n'.join([strip_comment(l) for l in data.split('\n')])
+    data = '\n'.join([' '.join(l.split()) for l in data.split('\n')])
+
+    string_ls = []
+    search = '"'
+    ok = True
+    last_i = 0
+    while ok:
+        ok = False
+        i = data.find(search, last_i)
+        if i != -1:
+            start = i + len(search)
+            end = data.find('"', start)
+            if end != -1:
+                item = data[start:end]
+                string_ls.append(item)
+                data = data[:start] + data[end:]
+                ok = True
+                last_i = (end - len(item)) + 1
+
+    data = data.replace('{', '\n{\n')
+    data = data.replace('}', '\n}\n')
+    data = data.replace('[', '\n[\n')
+    data = data.replace(']', '\n]\n')
+    data = data.replace(',', ' , ')
+
+    ok = True
+    last_i = 0
+    while ok:
+        ok = False
+        i = data.find(search + '"', last_i)
+        if i != -1:
+            start = i + len(search)
+            item = string_ls.pop(0)
+            data = data[:start] + item + data[start:]
+            last_i = start + len(item) + 1
+            ok = True
+
+    data = '\n'.join([' '.join(l.split()) for l in data.split('\n')])
+
+    return [l for l in data.split('\n') if l]
+
+
+# =============================== Benchmarks
+
+def ifs_faces_legacy(index):
+    """
+    The face splitting importMesh_IndexedFaceSet did before numpy, kept for comparison.
+    """
+    faces = []
+    face = []
+    for i in index:
+        if i == -1:
+            faces.append(face)
+            face = []
+        else:
+            face.append(i)
+    faces.append(face)
+    return faces
+
+
+def pixels_legacy(pixels, plane_count):
+    """
+    The PixelTexture decoding appearance_LoadPixelTexture did before numpy, kept for comparison.
+    """
+    if plane_count == 3:  # RGB
+        return [(cco & 0xff) / 255 for pixel in pixels
+                for cco in (pixel >> 16, pixel >> 8, pixel, 255)]
+    elif plane_count == 4:  # RGBA
+        return [(cco & 0xff) / 255 for pixel in pixels
+                for cco
+                in (pixel >> 24, pixel >> 16, pixel >> 8, pixel)]
+    elif plane_count == 1:  # Intensity
+        return [(cco & 0xff) / 255 for pixel in pixels
+                for cco in (pixel, pixel, pixel, 255)]
+    elif plane_count == 2:  # Intensity/aplha
+        return [(cco & 0xff) / 255 for pixel in pixels
+                for cco
+                in (pixel >> 8, pixel >> 8, pixel >> 8, pixel)]
+
+
+# {file: {stage: {'seconds': ..., 'peak': ...}}} of this run, for --save and --baseline
+results = {}
+results_file = None
+
+
+def keep(name, t, peak=None):
+    stage = results.setdefault(results_file, {})[name] = {'seconds': t}
+    if peak is not None:
+        stage['peak'] = peak
+
+
+def measure(func, *args):
+    # Timed and traced separately, tracemalloc slows down allocation heavy code a lot.
+    t = time.perf_counter()
+    result = func(*args)
+    t = time.perf_counter() - t
+    del result
+
+    tracemalloc.start()
+    result = func(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, t, peak
+
+
+def report(name, t, peak, size):
+    print ("  %-28s %8.3f s %8.1f MB/s   peak %8.1f MB" % (name, t, size / t / 1e6, peak / 1e6))
+    keep(name, t, peak)
+
+
+def begin(path):
+    # Generated files are known by name, they are made again for every run
+    global results_file
+    results_file = os.path.basename(path)
+    size = os.path.getsize(path)
+    print ("%s (%.1f MB)" % (path, size / 1e6))
+    return size
+
+
+def bench_tokenize(path, legacy):
+    size = begin(path)
+
+    def tokenize_count():
+        # Consume without keeping the lines, this is the tokenizer's own footprint
+        return sum(1 for l in import_x3d.vrmlTokenize(import_x3d.web3dChunks(path)))
+
+    def tokenize_list():
+        return list(import_x3d.vrmlTokenize(import_x3d.web3dChunks(path)))
+
+    def legacy_list():
+        f = open(path, 'r')
+        data = f.read()
+        f.close()
+        return vrmlFormat_legacy(data)
+
+    count, t, peak = measure(tokenize_count)
+    report("vrmlTokenize (streamed)", t, peak, size)
+    lines, t, peak = measure(tokenize_list)
+    report("vrmlTokenize (line list)", t, peak, size)
+
+    if legacy:
+        lines_legacy, t, peak = measure(legacy_list)
+        report("vrmlFormat (legacy)", t, peak, size)
+        if lines_legacy != lines:
+            print ("  ERROR: vrmlTokenize output differs from the legacy vrmlFormat")
+            return False
+
+    print ("  %d lines" % count)
+    return True
+
+
+def bench_faces(nodes):
+    # What importMesh_IndexedFaceSet does before handing the loops to Blender, for the biggest one
+    sets = [(len(node.getFieldAsArray('coordIndex', 0, ancestry)), i)
+            for i, (node, ancestry) in enumerate(nodes) if node.getSpec() == 'IndexedFaceSet']
+    for count, i in sorted(sets)[-1:]:
+        node, ancestry = nodes[i]
+        index = node.getFieldAsBuffer('coordIndex', 0, ancestry, np.int32)
+        end = len(index)
+        while end and index[end - 1] == -1:
+            end -= 1
+        index = index[:end]
+
+        def best(func, *args):
+            t_best = None
+            for i in range(3):
+                t = time.perf_counter()
+                func(*args)
+                t = time.perf_counter() - t
+                if t_best is None or t < t_best:
+                    t_best = t
+            return t_best
+
+        faces = import_x3d.ifsFaceLoops(index, True)[2]
+
+        # A colorIndex/normalIndex/texCoordIndex shorter than coordIndex is left out, not an error
+        gather = import_x3d.ifsFaceLoops(index, True)[0]
+        if gather(index[:-1]) is not None or len(gather(np.append(index, 0))) != faces.sum():
+            print ("  ERROR: ifsFaceLoops gathers an index of the wrong length")
+
+        t = best(ifs_faces_legacy, index.tolist())
+        print ("  %-28s %8.3f s  (%d faces)" % ("face split (legacy)", t, len(faces)))
+        t = best(lambda: import_x3d.ifsFaceLoops(index, True)[0](index))
+        print ("  %-28s %8.3f s" % ("face split (numpy)", t))
+        keep("face split (numpy)", t)
+
+        coord = node.getChildBySpec('Coordinate')
+        if coord:
+            points = coord.getFieldAsBuffer('point', 3, ancestry, np.float32)
+            kept = import_x3d.weldVertices(points, 0.0001)[0]
+            t = best(import_x3d.weldVertices, points, 0.0001)
+            print ("  %-28s %8.3f s  (%d of %d vertices left)" % ("weld vertices (0.0001)", t, len(kept), len(points)))
+            keep("weld vertices (0.0001)", t)
+
+
+def bench_primitives(nodes):
+    # Meshes made for Sphere/Cylinder/Cone/Box, before and after sharing them
+    shapes = [(node, ancestry) for node, ancestry in nodes if node.getSpec() == 'Shape']
+
+    def template_keys():
+        keys = set()
+        count = 0
+        for node, ancestry in shapes:
+            geom = node.getChildBySpec(list(import_x3d.primitive_specs))
+            if geom is None:
+                continue
+            # The material key stands in for the material Blender would make
+            appr = node.getChildBySpec('Appearance')
+            material = appr.getChildBySpec('Material') if appr else None
+            import_x3d.primitiveSize(geom, ancestry)
+            keys.add(import_x3d.primitiveKey(geom, ancestry) + (import_x3d.materialKey(material, ancestry) if material else None,))
+            count += 1
+        return count, keys
+
+    (count, keys), t, peak = measure(template_keys)
+    if count:
+        print ("  %-28s %8.3f s  (%d primitives, %d meshes instead of %d)" % ("primitive templates", t, count, len(keys), count))
+
+
+def bench_materials(nodes):
+    # Material cache keys, one Blender material is made for each different one
+    def material_keys():
+        keys = set()
+        count = 0
+        for node, ancestry in nodes:
+            if node.getSpec() != 'Shape':
+                continue
+            appr = node.getChildBySpec('Appearance')
+            if appr is None:
+                continue
+            material = appr.getChildBySpec('Material')
+            tex_node = appr.getChildBySpec(('ImageTexture', 'PixelTexture'))
+            keys.add((import_x3d.materialKey(material, ancestry) if material else None,
+                      import_x3d.textureKey(tex_node, ancestry, node) if tex_node else None))
+            count += 1
+        return count, keys
+
+    (count, keys), t, peak = measure(material_keys)
+    if count:
+        print ("  %-28s %8.3f s  (%d appearances, %d materials)" % ("material keys", t, count, len(keys)))
+        keep("material keys", t)
+
+
+def bench_pixels(nodes):
+    # The RGBA floats appearance_LoadPixelTexture hands to Blender, for every PixelTexture DEF
+    for node, ancestry in nodes:
+        if node.getSpec() != 'PixelTexture' or node.reference:
+            continue
+        image = import_x3d.pixelTextureImage(node, ancestry)
+        if image is None:
+            continue
+        w, h, plane_count, pixels = image
+
+        rgba_legacy, t, peak = measure(pixels_legacy, pixels.tolist(), plane_count)
+        print ("  %-28s %8.3f s  peak %8.1f MB  (%dx%d)" % ("pixel decode (legacy)", t, peak / 1e6, w, h))
+        rgba, t, peak = measure(import_x3d.pixelTextureRGBA, pixels, plane_count)
+        print ("  %-28s %8.3f s  peak %8.1f MB" % ("pixel decode (numpy)", t, peak / 1e6))
+        keep("pixel decode (numpy)", t, peak)
+        if rgba_legacy is not None and not (rgba == np.array(rgba_legacy, dtype=np.float32)).all():
+            print ("  ERROR: pixelTextureRGBA output differs from the legacy decoding")
+
+
+def bench_parenting(nodes):
+    # Parents of the objects load_web3d makes, a stand-in object for every Transform and Shape
+    owners = [node for node, ancestry in nodes if node.getSpec() in ('Transform', 'Shape')]
+    for node in owners:
+        node.blendObject = object()
+    try:
+        child_dict, t, peak = measure(import_x3d.parentMap, nodes)
+        print ("  %-28s %8.3f s  (%d objects, %d parents)" % ("parent map", t, len(owners), len(child_dict)))
+        keep("parent map", t)
+    finally:
+        for node in owners:
+            node.blendObject = None
+
+
+def bench_serialize(root):
+    # The (node, ancestry) list load_web3d walks, it lives as long as the import
+    nodes, t, peak = measure(lambda: root.getSerialized([], []))
+    print ("  %-28s %8.3f s                 peak %8.1f MB  (%d nodes)" % ("getSerialized", t, peak / 1e6, len(nodes)))
+    keep("getSerialized", t, peak)
+    return nodes
+
+
+def bench_x3d(path):
+    size = begin(path)
+
+    def minidom_tree():
+        # What x3d_parse used to hold on to before making any nodes
+        import xml.dom.minidom
+        f = open(path, 'r')
+        data = f.read()
+        f.close()
+        return xml.dom.minidom.parseString(data)
+
+    def x3d_tree():
+        return import_x3d.x3d_parse(path)[0]
+
+    root, t, peak = measure(x3d_tree)
+    if root is None:
+        print ("  ERROR: could not parse")
+        return False
+    report("x3d_parse (expat)", t, peak, size)
+
+    doc, t, peak = measure(minidom_tree)
+    report("minidom.parseString (legacy)", t, peak, size)
+
+    nodes = bench_serialize(root)
+
+    def read_arrays():
+        count = 0
+        for node, ancestry in nodes:
+            spec = node.getSpec()
+            if spec == 'IndexedFaceSet':
+                count += len(node.getFieldAsArray('coordIndex', 0, ancestry))
+            elif spec == 'Coordinate':
+                count += len(node.getFieldAsBuffer('point', 3, ancestry, np.float32))
+            elif spec == 'Color':
+                count += len(node.getFieldAsBuffer('color', 3, ancestry, np.float32))
+        return count
+
+    t = time.perf_counter()
+    count = read_arrays()
+    t = time.perf_counter() - t
+    print ("  %-28s %8.3f s  (%d values)" % ("array fields (first read)", t, count))
+    keep("array fields (first read)", t)
+
+    # Attributes stay text in X3D, the getFieldAs* lookups convert them
+    for node, ancestry in nodes:
+        if node.x3dNode is None:
+            continue
+        for name, value in node.x3dNode.attributes.items():
+            if value.strip().isdigit() and node.getFieldAsInt(name, None, ancestry) != int(value):
+                print ("  ERROR: %s %s=\"%s\" is not read as an int" % (node.getSpec(), name, value))
+                return False
+
+    bench_faces(nodes)
+    bench_primitives(nodes)
+    bench_materials(nodes)
+    bench_pixels(nodes)
+    bench_parenting(nodes)
+
+    # What the next import of the same file costs
+    t = time.perf_counter()
+    saved = import_x3d.sceneCacheSave(path, root)
+    t = time.perf_counter() - t
+    if saved:
+        print ("  %-28s %8.3f s" % ("sceneCacheSave", t))
+        keep("sceneCacheSave", t)
+        root_cached, t, peak = measure(import_x3d.sceneCacheLoad, path)
+        report("sceneCacheLoad", t, peak, os.path.getsize(path))
+    t = time.perf_counter()
+    read_arrays()
+    t = time.perf_counter() - t
+    print ("  %-28s %8.3f s" % ("array fields (again)", t))
+
+    print ("  %d nodes" % len(nodes))
+    return True
+
+
+def bench_fields(path):
+    # The parse, then the lookups load_web3d does for every node
+    (root, msg), t, peak = measure(import_x3d.vrml_parse, path)
+    if root is None:
+        print ("  ERROR: %s" % msg)
+        return False
+    report("vrml_parse", t, peak, os.path.getsize(path))
+
+    nodes = bench_serialize(root)
+
+    def read_arrays():
+        # Large number blocks are decoded here on first use
+        count = 0
+        for node, ancestry in nodes:
+            spec = node.getSpec()
+            if spec in {'Coordinate', 'Color'}:
+                count += len(node.getFieldAsBuffer(spec == 'Coordinate' and 'point' or 'color', 3, ancestry, np.float32))
+            elif spec == 'IndexedFaceSet':
+                count += len(node.getFieldAsBuffer('coordIndex', 0, ancestry, np.int32))
+        return count
+
+    t = time.perf_counter()
+    count = read_arrays()
+    t = time.perf_counter() - t
+    print ("  %-28s %8.3f s  (%d values)" % ("array fields (first read)", t, count))
+    keep("array fields (first read)", t)
+    bench_faces(nodes)
+    bench_primitives(nodes)
+    bench_materials(nodes)
+    bench_pixels(nodes)
+    bench_parenting(nodes)
+
+    # What the next import of the same file costs
+    t = time.perf_counter()
+    saved = import_x3d.sceneCacheSave(path, root)
+    t = time.perf_counter() - t
+    if saved:
+        print ("  %-28s %8.3f s" % ("sceneCacheSave", t))
+        keep("sceneCacheSave", t)
+        root_cached, t, peak = measure(import_x3d.sceneCacheLoad, path)
+        report("sceneCacheLoad", t, peak, os.path.getsize(path))
+
+    def lookup_fields():
+        count = 0
+        for node, ancestry in nodes:
+            spec = node.getSpec()
+            if spec == 'Transform':
+                node.getFieldAsFloatTuple('center', (0.0, 0.0, 0.0), ancestry)
+                node.getFieldAsFloatTuple('rotation', (0.0, 0.0, 1.0, 0.0), ancestry)
+                node.getFieldAsFloatTuple('scale', (1.0, 1.0, 1.0), ancestry)
+                node.getFieldAsFloatTuple('scaleOrientation', (0.0, 0.0, 1.0, 0.0), ancestry)
+                node.getFieldAsFloatTuple('translation', (0.0, 0.0, 0.0), ancestry)
+                count += 5
+            elif spec == 'Material':
+                node.getFieldAsFloat('ambientIntensity', 0.2, ancestry)
+                node.getFieldAsFloatTuple('diffuseColor', [0.8, 0.8, 0.8], ancestry)
+                node.getFieldAsFloatTuple('emissiveColor', [0.0, 0.0, 0.0], ancestry)
+                node.getFieldAsFloat('shininess', 0.2, ancestry)
+                node.getFieldAsFloatTuple('specularColor', [0.0, 0.0, 0.0], ancestry)
+                node.getFieldAsFloat('transparency', 0.0, ancestry)
+                count += 6
+            elif spec == 'Sphere':
+                node.getFieldAsFloat('radius', 1.0, ancestry)
+                count += 1
+        return count
+
+    # Best of a few runs, the first one also fills the PROTO lookup caches
+    t_best = None
+    for i in range(5):
+        count, t, peak = measure(lookup_fields)
+        if t_best is None or t < t_best:
+            t_best = t
+    print ("  %-28s %8.3f s %8.2f us/lookup  (%d nodes, %d lookups)" % ("getFieldAs* lookups", t_best, t_best / count * 1e6, len(nodes), count))
+    keep("getFieldAs* lookups", t_best)
+    return True
+
+
+def compare(baseline, tolerance):
+    """
+    Prints the stages that are slower or use more memory than in the baseline,
+    returns False if there are any. Differences below a hundredth of a second
+    or a MB are noise and are left out.
+    """
+    ok = True
+    for name, stages in sorted(results.items()):
+        for stage, now in sorted(stages.items()):
+            was = baseline['files'].get(name, {}).get(stage, {})
+            for key, noise, unit, scale in (('seconds', 0.01, 's', 1), ('peak', 1e6, 'MB', 1e-6)):
+                if key in now and key in was and now[key] - was[key] > max(noise, was[key] * tolerance):
+                    print ("  REGRESSION %s %s: %s %.3f %s, was %.3f" % (name, stage, key, now[key] * scale, unit, was[key] * scale))
+                    ok = False
+    return ok
+
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hn:", ["help", "no-legacy", "save=", "baseline=", "tolerance="])
+    except getopt.GetoptError as err:
+        print (str(err))
+        usage()
+        sys.exit(2)
+
+    vertex_count = 20000
+    legacy = True
+    save = None
+    baseline = None
+    tolerance = 0.25
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif o == "-n":
+            vertex_count = int(a)
+        elif o == "--no-legacy":
+            legacy = False
+        elif o == "--save":
+            save = a
+        elif o == "--baseline":
+            f = open(a, 'r')
+            baseline = json.load(f)
+            f.close()
+        elif o == "--tolerance":
+            tolerance = float(a)
+
+    if baseline is not None and not args and baseline['n'] != vertex_count:
+        print ("The baseline was made with -n %d" % baseline['n'])
+        sys.exit(2)
+
+    tmpdir = tempfile.mkdtemp()
+    import_x3d.SCENE_CACHE_DIR = os.path.join(tmpdir, 'cache')
+    if not args:
+        os.mkdir(os.path.join(tmpdir, 'inline'))
+        args = [os.path.join(tmpdir, name) for name in ('surface.wrl', 'shapes.wrl', 'protos.wrl', 'cpk.wrl',
+                                                        'ribbon.wrl', 'defuse.wrl', os.path.join('inline', 'inline.wrl'),
+                                                        'pixels.wrl', 'surface.x3d', 'shapes.x3d')]
+        write_surface_wrl(args[0], vertex_count)
+        write_shapes_wrl(args[1], vertex_count // 10)
+        write_protos_wrl(args[2], vertex_count // 10)
+        write_cpk_wrl(args[3], vertex_count)
+        write_ribbon_wrl(args[4], vertex_count)
+        write_defuse_wrl(args[5], vertex_count // 10)
+        write_inline_wrl(args[6], vertex_count)
+        write_pixels_wrl(args[7], vertex_count * 10)
+        write_surface_x3d(args[8], vertex_count)
+        write_shapes_x3d(args[9], vertex_count // 10)
+
+    ok = True
+    for path in args:
+        if path.lower().endswith('.x3d'):
+            ok = bench_x3d(path) and ok
+            continue
+        ok = bench_tokenize(path, legacy) and ok
+        ok = bench_fields(path) and ok
+
+    shutil.rmtree(tmpdir)
+
+    results['peak RSS'] = {'process': {'peak': import_x3d.peakRSS()}}
+    print ("peak RSS %.1f MB" % (results['peak RSS']['process']['peak'] / 1e6))
+
+    if save:
+        f = open(save, 'w')
+        json.dump({'n': vertex_count, 'python': sys.version.split()[0], 'numpy': np.__version__, 'files': results},
+                  f, indent=1, sort_keys=True)
+        f.close()
+
+    if baseline is not None:
+        print ("Compared with the baseline, tolerance %d%%" % (tolerance * 100))
+        ok = compare(baseline, tolerance) and ok
+
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
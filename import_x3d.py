@@ -5,32 +5,190 @@ DEBUG = False
 
 # This should work without a blender at all
 import os
+import re
+import sys
+import types
+import io
+import gzip
+import zlib
+import json
+import time
+import mmap
+import codecs
 import shlex
 import math
+import hashlib
+import subprocess
+import warnings
+import numpy as np
 from math import sin, cos, pi
 
 texture_cache = {}
 material_cache = {}
+primitive_cache = {}
+transform_cache = {}
+object_queue = []
 
 EPSILON = 0.0000001  # Very crude.
 
+# Parsed scenes are kept here so importing the same file again skips the parser,
+# when the import asks for it (load_web3d's PREF_CACHE, load's use_cache).
+# Set IMPORT_X3D_CACHE to use another directory, or to an empty string to turn it off.
+SCENE_CACHE_DIR = os.environ.get('IMPORT_X3D_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'import_x3d'))
+SCENE_CACHE_SIZE = 2 << 30  # bytes, the least recently used scenes are removed past this
 
-def imageConvertCompat(path):
+# Converted GIF's, by the hash of the GIF, same switch
+TEXTURE_CACHE_DIR = os.path.join(SCENE_CACHE_DIR, 'textures') if SCENE_CACHE_DIR else ''
+TEXTURE_CACHE_SIZE = 512 << 20  # bytes, the least recently used images are removed past this
+
+# Set IMPORT_X3D_STATS to a file to append a JSON record of every import to it, '-' to print it.
+IMPORT_STATS_PATH = os.environ.get('IMPORT_X3D_STATS', '')
+
+
+class importStats(object):
+    """
+    Seconds and calls of each import phase, with counts of what was made.
+    Phases nest, the time of a phase doesn't include the phases started
+    inside it, so tokenize doesn't count the time reading the file.
+    """
+    __slots__ = ('phases', 'counts', 'info', 'stack', 'started')
+
+    def __init__(self):
+        self.phases = {}
+        self.counts = {}
+        self.info = {}
+        self.stack = []
+        self.started = time.perf_counter()
+
+    def start(self, name):
+        self.stack.append([name, time.perf_counter(), 0.0])
+
+    def stop(self):
+        name, started, inner = self.stack.pop()
+        elapsed = time.perf_counter() - started
+        phase = self.phases.get(name)
+        if phase is None:
+            phase = self.phases[name] = [0.0, 0]
+        phase[0] += elapsed - inner
+        phase[1] += 1
+        if self.stack:
+            self.stack[-1][2] += elapsed
+
+    def phase(self, name):
+        return importPhase(self, name)
+
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def record(self, path):
+        record = {
+            'file': os.path.abspath(path),
+            'seconds': time.perf_counter() - self.started,
+            'phases': {name: {'seconds': seconds, 'calls': calls}
+                       for name, (seconds, calls) in self.phases.items()},
+            'counts': self.counts,
+            'peak_rss': peakRSS(),
+            'time': time.time(),
+        }
+        record.update(self.info)
+        try:
+            record['bytes'] = os.path.getsize(path)
+        except OSError:
+            pass
+        return record
+
+    def write(self, path, target):
+        line = json.dumps(self.record(path), sort_keys=True)
+        if target == '-':
+            print(line)
+        else:
+            with open(target, 'a') as f:
+                f.write(line + '\n')
+
+
+class importPhase(object):
+    __slots__ = ('stats', 'name')
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.stats.start(self.name)
+
+    def __exit__(self, *args):
+        self.stats.stop()
+
+
+def peakRSS():
+    """
+    The most memory this process has used in bytes, None where it is not known (win32).
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on mac, KB elsewhere
+    return rss if os.uname()[0] == 'Darwin' else rss * 1024
+
+class importStatsOff(importStats):
+    """
+    Stats nobody asked for, nothing is recorded so any number of parses can share it.
+    """
+    __slots__ = ()
+
+    def start(self, name):
+        pass
+
+    def stop(self):
+        pass
+
+    def count(self, name, n=1):
+        pass
+
+# The default of the parser and import functions, load_web3d passes its own importStats
+NO_STATS = importStatsOff()
+
+
+def imageConvertGif(path, path_to):
+    """
+    Write the GIF at path as a PNG, with Pillow when it's installed,
+    else with image magick, without a shell so any file name works.
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        Image = None
+
+    if Image is not None:
+        Image.open(path).save(path_to, 'PNG')
+    else:
+        subprocess.call(['convert', path, path_to])  # for now just hope we have image magick
+
+
+def imageConvertCompat(path, cache=False):
 
     if os.sep == '\\':
         return path  # assume win32 has quicktime, dont convert
 
     if path.lower().endswith('.gif'):
-        path_to = path[:-3] + 'png'
-
-        '''
-        if exists(path_to):
+        # With the cache, converted once, the PNG is kept by the hash of the GIF
+        key = fileDigest((path,)) if cache and TEXTURE_CACHE_DIR else None
+        path_to = textureCacheGet(key, '.png') if key else None
+        if path_to:
             return path_to
-        '''
-        # print('\n'+path+'\n'+path_to+'\n')
-        os.system('convert "%s" "%s"' % (path, path_to))  # for now just hope we have image magick
 
-        if os.path.exists(path_to):
+        if key:
+            path_to = textureCacheStore(key, '.png', lambda tmp: imageConvertGif(path, tmp))
+        else:
+            path_to = path[:-3] + 'png'
+            try:
+                imageConvertGif(path, path_to)
+            except OSError:
+                pass
+
+        if path_to and os.path.exists(path_to):
             return path_to
 
     return path
@@ -49,9 +207,38 @@ def vrmlFormat(data):
     """
     Keep this as a valid vrml file, but format in a way we can predict.
     """
+    return list(vrmlTokenize((data,)))
+
+
+VRML_SPECIAL = re.compile('["#]')
+
+
+def vrmlSplitBrackets(text):
+    # Outside of strings every bracket gets its own line and comma's are always surrounded by spaces.
+    text = text.replace('{', '\n{\n')
+    text = text.replace('}', '\n}\n')
+    text = text.replace('[', '\n[\n')
+    text = text.replace(']', '\n]\n')
+    return text.replace(',', ' , ')
+
+
+def vrmlSplitLines(text):
+    # remove all whitespace, drop empty lines
+    ls = [' '.join(l.split()) for l in text.split('\n')]
+    return [l for l in ls if l]
+
+
+def vrmlTokenize(chunks):
+    """
+    Single pass version of vrmlFormat, takes an iterable of text chunks
+    and yields the formatted lines as they become available.
+
+    Blocks of lines without strings or comments (nearly all of a large file)
+    are formatted in bulk, the rest line by line. Only a string spanning
+    multiple lines is held back until it is closed.
+    """
     # Strip all commends - # not in strings - warning multiline strings are ignored.
     def strip_comment(l):
-        #l = ' '.join(l.split())
         l = l.strip()
 
         if l.startswith('#'):
@@ -63,7 +250,6 @@ def vrmlFormat(data):
             return l
 
         # Most cases accounted for! if we have a comment at the end of the line do this...
-        #j = l.find('url "')
         j = l.find('"')
 
         if j == -1:  # simple no strings
@@ -80,226 +266,427 @@ def vrmlFormat(data):
 
         return l
 
-    data = '\n'.join([strip_comment(l) for l in data.split('\n')])  # remove all whitespace
+    # Lines belonging to a string that has not been closed yet.
+    pending = []
+    pending_quotes = 0
+
+    def format_group(group, at_end=False):
+        # Strings are kept as they are, everything between them is split on brackets.
+        parts = '\n'.join(group).split('"')
+        for i in range(0, len(parts), 2):
+            parts[i] = vrmlSplitBrackets(parts[i])
+        if at_end and len(parts) % 2 == 0:
+            # Unterminated string, the last quote is not treated as one.
+            parts[-1] = vrmlSplitBrackets(parts[-1])
+        return vrmlSplitLines('"'.join(parts))
+
+    def format_line(l):
+        nonlocal pending_quotes
+        l = ' '.join(strip_comment(l).split())
+        quotes = l.count('"')
+
+        if pending:
+            pending.append(l)
+            pending_quotes += quotes
+        elif quotes % 2:
+            pending.append(l)
+            pending_quotes = quotes
+        else:
+            return format_group((l,))
+
+        if pending_quotes % 2:
+            return []  # Still inside the string
+
+        ls = format_group(pending)
+        del pending[:]
+        return ls
+
+    def format_block(block):
+        # block holds complete lines only
+        pos = 0
+        size = len(block)
+        while pos < size:
+            if not pending:
+                m = VRML_SPECIAL.search(block, pos)
+                if m is None:
+                    yield from vrmlSplitLines(vrmlSplitBrackets(block[pos:]))
+                    return
+
+                special = m.start()
+                start = block.rfind('\n', pos, special) + 1
+                if start == 0:
+                    start = pos
+                elif start > pos:
+                    yield from vrmlSplitLines(vrmlSplitBrackets(block[pos:start]))
+            else:
+                special = start = pos
 
-    EXTRACT_STRINGS = True  # only needed when strings or filesnames containe ,[]{} chars :/
+            end = block.find('\n', special)
+            if end == -1:
+                end = size
 
-    if EXTRACT_STRINGS:
+            yield from format_line(block[start:end])
+            pos = end + 1
 
-        # We need this so we can detect URL's
-        data = '\n'.join([' '.join(l.split()) for l in data.split('\n')])  # remove all whitespace
+    carry = ''
+    for chunk in chunks:
+        text = carry + chunk
+        cut = text.rfind('\n')
+        if cut == -1:
+            carry = text
+            continue
 
-        string_ls = []
+        carry = text[cut + 1:]
+        yield from format_block(text[:cut])
 
-        #search = 'url "'
-        search = '"'
+    yield from format_line(carry)
 
-        ok = True
-        last_i = 0
-        while ok:
-            ok = False
-            i = data.find(search, last_i)
-            if i != -1:
+    if pending:
+        yield from format_group(pending, at_end=True)
 
-                start = i + len(search)  # first char after end of search
-                end = data.find('"', start)
-                if end != -1:
-                    item = data[start:end]
-                    string_ls.append(item)
-                    data = data[:start] + data[end:]
-                    ok = True  # keep looking
+NODE_NORMAL = 1  # {}
+NODE_ARRAY = 2  # []
+NODE_REFERENCE = 3  # USE foobar
+# NODE_PROTO = 4 #
 
-                    last_i = (end - len(item)) + 1
-                    # print(last_i, item, '|' + data[last_i] + '|')
+VRML_NUMBERS = re.compile('[-+.0-9eE ,\n]+')
 
-    # done with messy extracting strings part
+# Number blocks with at least this many lines are kept as text by the parser
+# and only decoded when the importer asks for them, see vrmlNode.decodeArrayData()
+LAZY_ARRAY_LINES = 64
 
-    # Bad, dont take strings into account
-    '''
-    data = data.replace('#', '\n#')
-    data = '\n'.join([ll for l in data.split('\n') for ll in (l.strip(),) if not ll.startswith('#')]) # remove all whitespace
-    '''
-    data = data.replace('{', '\n{\n')
-    data = data.replace('}', '\n}\n')
-    data = data.replace('[', '\n[\n')
-    data = data.replace(']', '\n]\n')
-    data = data.replace(',', ' , ')  # make sure comma's separate
 
-    if EXTRACT_STRINGS:
-        # add strings back in
+def vrmlDecodeNumbers(text):
+    """
+    Decode a block of numbers in one go, comma's and newlines are optional.
+    Returns an int32 array (int64 if the values dont fit), a float32 array,
+    or None if the text is not just numbers.
+    """
+    if VRML_NUMBERS.fullmatch(text) is None:
+        return None
 
-        search = '"'  # fill in these empty strings
+    text = text.replace(',', ' ')
+    if text.isspace():
+        return None  # numpy reads this as a single 0
 
-        ok = True
-        last_i = 0
-        while ok:
-            ok = False
-            i = data.find(search + '"', last_i)
-            # print(i)
-            if i != -1:
-                start = i + len(search)  # first char after end of search
-                item = string_ls.pop(0)
-                # print(item)
-                data = data[:start] + item + data[start:]
+    is_float = '.' in text or 'e' in text or 'E' in text
 
-                last_i = start + len(item) + 1
+    with warnings.catch_warnings():
+        # Newer numpy warns about (or refuses) text that could only be parsed partially.
+        warnings.simplefilter('error')
+        try:
+            data = np.fromstring(text, dtype=np.float64 if is_float else np.int64, sep=' ')
+        except (ValueError, DeprecationWarning):
+            return None
 
-                ok = True
+    if is_float:
+        return data.astype(np.float32)
 
-    # More annoying obscure cases where USE or DEF are placed on a newline
-    # data = data.replace('\nDEF ', ' DEF ')
-    # data = data.replace('\nUSE ', ' USE ')
+    if len(data) and (data.min() < -0x80000000 or data.max() > 0x7fffffff):
+        return data  # eg: PixelTexture pixels
+    return data.astype(np.int32)
 
-    data = '\n'.join([' '.join(l.split()) for l in data.split('\n')])  # remove all whitespace
 
-    # Better to parse the file accounting for multiline arrays
-    '''
-    data = data.replace(',\n', ' , ') # remove line endings with commas
-    data = data.replace(']', '\n]\n') # very very annoying - but some comma's are at the end of the list, must run this again.
-    '''
+def vrmlIsNumline(l):
+    """
+    Does this formatted line start with a number?
+    """
+    line_start = 0
 
-    return [l for l in data.split('\n') if l]
+    if l.startswith(', '):
+        line_start += 2
 
-NODE_NORMAL = 1  # {}
-NODE_ARRAY = 2  # []
-NODE_REFERENCE = 3  # USE foobar
-# NODE_PROTO = 4 #
+    line_end = len(l) - 1
+    line_end_new = l.find(' ', line_start)  # comma's always have a space before them
 
-lines = []
+    if line_end_new != -1:
+        line_end = line_end_new
 
+    try:
+        float(l[line_start:line_end])  # works for a float or int
+        return True
+    except:
+        return False
 
-def getNodePreText(i, words):
-    # print(lines[i])
-    use_node = False
-    while len(words) < 5:
 
-        if i >= len(lines):
+VRML_NUMBER_START = frozenset('0123456789+-.')
+
+
+def vrmlField(words):
+    """
+    A field as nodes keep it: ['diffuseColor', '1', '0', '0'] -> ('diffuseColor', 1, 0, 0).
+    Numbers are converted here once instead of on every lookup, other words
+    are interned so a name or keyword (TRUE, IS...) used on thousands of
+    nodes is one string. Quoted strings are kept as they are.
+    """
+    field = []
+    for word in words:
+        if type(word) == str:
+            if word[0] in VRML_NUMBER_START:
+                if '_' not in word:  # python reads 1_000, VRML doesn't
+                    try:
+                        word = int(word)
+                    except ValueError:
+                        try:
+                            word = float(word)
+                        except ValueError:
+                            pass
+            elif word[0] != '"':
+                word = sys.intern(word)
+        field.append(word)
+    return tuple(field)
+
+
+def vrmlLineValues(l):
+    """
+    Convert one formatted line of an array, the slow way:
+    '1 2 3 ,' -> [1, 2, 3], '1 2 , 3 4' -> [[1, 2], [3, 4]], strings when it's not numbers.
+    """
+    l_split = l.split(',')
+
+    values = None
+    # See if each item is a float?
+
+    for num_type in (int, float):
+        try:
+            values = [num_type(v) for v in l_split]
             break
-            '''
-        elif lines[i].startswith('PROTO'):
-            return NODE_PROTO, i+1
-            '''
-        elif lines[i] == '{':
-            # words.append(lines[i]) # no need
-            # print("OK")
-            return NODE_NORMAL, i + 1
-        elif lines[i].count('"') % 2 != 0:  # odd number of quotes? - part of a string.
-            # print('ISSTRING')
+        except:
+            pass
+
+        try:
+            values = [[num_type(v) for v in segment.split()] for segment in l_split]
             break
-        else:
-            new_words = lines[i].split()
-            if 'USE' in new_words:
-                use_node = True
+        except:
+            pass
 
-            words.extend(new_words)
-            i += 1
+    if values is None:  # dont parse
+        values = l_split
 
-        # Check for USE node - no {
-        # USE #id - should always be on the same line.
-        if use_node:
-            # print('LINE', i, words[:words.index('USE')+2])
-            words[:] = words[:words.index('USE') + 2]
-            if lines[i] == '{' and lines[i + 1] == '}':
-                # USE sometimes has {} after it anyway
-                i += 2
-            return NODE_REFERENCE, i
+    return values
 
-    # print("error value!!!", words)
-    return 0, -1
 
+class vrmlParseContext(object):
+    """
+    Parser state for one file, the formatted lines and helpers to look at them.
+    Every file (and every Inline or EXTERNPROTO it loads) gets its own context,
+    so parsing is re-entrant and several files can be parsed at once.
+    """
+    __slots__ = ('lines', 'stats')
 
-def is_nodeline(i, words):
+    def __init__(self, lines, stats=NO_STATS):
+        self.lines = lines
+        self.stats = stats  # Inline's are timed in the same stats as the file
 
-    if not lines[i][0].isalpha():
-        return 0, 0
+    def getNodePreText(self, i, words):
+        lines = self.lines
+        # print(lines[i])
+        use_node = False
+        while len(words) < 5:
 
-    #if lines[i].startswith('field'):
-    #   return 0, 0
+            if i >= len(lines):
+                break
+                '''
+            elif lines[i].startswith('PROTO'):
+                return NODE_PROTO, i+1
+                '''
+            elif lines[i] == '{':
+                # words.append(lines[i]) # no need
+                # print("OK")
+                return NODE_NORMAL, i + 1
+            elif lines[i].count('"') % 2 != 0:  # odd number of quotes? - part of a string.
+                # print('ISSTRING')
+                break
+            else:
+                new_words = lines[i].split()
+                if 'USE' in new_words:
+                    use_node = True
 
-    # Is this a prototype??
-    if lines[i].startswith('PROTO'):
-        words[:] = lines[i].split()
-        return NODE_NORMAL, i + 1  # TODO - assumes the next line is a '[\n', skip that
-    if lines[i].startswith('EXTERNPROTO'):
-        words[:] = lines[i].split()
-        return NODE_ARRAY, i + 1  # TODO - assumes the next line is a '[\n', skip that
+                words.extend(new_words)
+                i += 1
 
-    '''
-    proto_type, new_i = is_protoline(i, words, proto_field_defs)
-    if new_i != -1:
-        return proto_type, new_i
-    '''
+            # Check for USE node - no {
+            # USE #id - should always be on the same line.
+            if use_node:
+                # print('LINE', i, words[:words.index('USE')+2])
+                words[:] = words[:words.index('USE') + 2]
+                if lines[i] == '{' and lines[i + 1] == '}':
+                    # USE sometimes has {} after it anyway
+                    i += 2
+                return NODE_REFERENCE, i
+
+        # print("error value!!!", words)
+        return 0, -1
 
-    # Simple "var [" type
-    if lines[i + 1] == '[':
-        if lines[i].count('"') % 2 == 0:
+    def is_nodeline(self, i, words):
+        lines = self.lines
+
+        if not lines[i][0].isalpha():
+            return 0, 0
+
+        #if lines[i].startswith('field'):
+        #   return 0, 0
+
+        # Is this a prototype??
+        if lines[i].startswith('PROTO'):
             words[:] = lines[i].split()
-            return NODE_ARRAY, i + 2
+            return NODE_NORMAL, i + 1  # TODO - assumes the next line is a '[\n', skip that
+        if lines[i].startswith('EXTERNPROTO'):
+            words[:] = lines[i].split()
+            return NODE_ARRAY, i + 1  # TODO - assumes the next line is a '[\n', skip that
+
+        '''
+        proto_type, new_i = is_protoline(i, words, proto_field_defs)
+        if new_i != -1:
+            return proto_type, new_i
+        '''
 
-    node_type, new_i = getNodePreText(i, words)
+        # Simple "var [" type
+        if lines[i + 1] == '[':
+            if lines[i].count('"') % 2 == 0:
+                words[:] = lines[i].split()
+                return NODE_ARRAY, i + 2
 
-    if not node_type:
-        if DEBUG:
-            print("not node_type", lines[i])
-        return 0, 0
-
-    # Ok, we have a { after some values
-    # Check the values are not fields
-    for i, val in enumerate(words):
-        if i != 0 and words[i - 1] in {'DEF', 'USE'}:
-            # ignore anything after DEF, it is a ID and can contain any chars.
-            pass
-        elif val[0].isalpha() and val not in {'TRUE', 'FALSE'}:
-            pass
-        else:
-            # There is a number in one of the values, therefor we are not a node.
+        node_type, new_i = self.getNodePreText(i, words)
+
+        if not node_type:
+            if DEBUG:
+                print("not node_type", lines[i])
             return 0, 0
 
-    #if node_type==NODE_REFERENCE:
-    #   print(words, "REF_!!!!!!!")
-    return node_type, new_i
+        # Ok, we have a { after some values
+        # Check the values are not fields
+        for i, val in enumerate(words):
+            if i != 0 and words[i - 1] in {'DEF', 'USE'}:
+                # ignore anything after DEF, it is a ID and can contain any chars.
+                pass
+            elif val[0].isalpha() and val not in {'TRUE', 'FALSE'}:
+                pass
+            else:
+                # There is a number in one of the values, therefor we are not a node.
+                return 0, 0
+
+        #if node_type==NODE_REFERENCE:
+        #   print(words, "REF_!!!!!!!")
+        return node_type, new_i
 
+    def is_numline(self, i):
+        """
+        Does this line start with a number?
+        """
+        lines = self.lines
+
+        # Works but too slow.
+        '''
+        l = lines[i]
+        for w in l.split():
+            if w==',':
+                pass
+            else:
+                try:
+                    float(w)
+                    return True
 
-def is_numline(i):
+                except:
+                    return False
+
+        return False
+        '''
+
+        return vrmlIsNumline(lines[i])
+
+    def decodeBlock(self, i):
+        """
+        Decode the lines from i up to the closing ']' as a single array.
+        Returns (array, index of the ']') or (None, i) when the block is not all numbers.
+        Large blocks are only checked, their text is returned instead of an array.
+        """
+        lines = self.lines
+        try:
+            j = lines.index(']', i)
+        except ValueError:
+            return None, i
+
+        text = '\n'.join(lines[i:j])
+        if j - i >= LAZY_ARRAY_LINES:
+            if VRML_NUMBERS.fullmatch(text) is None:
+                return None, i
+            return text, j
+
+        data = vrmlDecodeNumbers(text)
+        if data is None:
+            return None, i
+
+        return data, j
+
+
+def groupBuffer(data, group):
     """
-    Does this line start with a number?
+    Reshape a flat array into rows of group items, group of 0 or -1 returns it flat.
     """
+    if group <= 0:
+        return data
 
-    # Works but too slow.
-    '''
-    l = lines[i]
-    for w in l.split():
-        if w==',':
-            pass
-        else:
-            try:
-                float(w)
-                return True
+    n = len(data) - len(data) % group
+    if n != len(data):
+        print('\twarning, array was not aligned to requested grouping', group, 'remaining value', data[n:].tolist())
+        data = data[:n]
 
-            except:
-                return False
+    return data.reshape(-1, group)
 
-    return False
-    '''
 
-    l = lines[i]
+def groupArray(array_data, group):
+    """
+    Flatten a (nested) list and regroup it into lists of group items,
+    group of 0 returns it flat, -1 as it is.
+    """
+    # print('array_data', array_data)
+    if group == -1 or len(array_data) == 0:
+        return array_data
+
+    # We want a flat list
+    flat = True
+    for item in array_data:
+        if type(item) == list:
+            flat = False
+            break
 
-    line_start = 0
+    # make a flat array
+    if flat:
+        flat_array = array_data  # we are already flat.
+    else:
+        flat_array = []
 
-    if l.startswith(', '):
-        line_start += 2
+        def extend_flat(ls):
+            for item in ls:
+                if type(item) == list:
+                    extend_flat(item)
+                else:
+                    flat_array.append(item)
 
-    line_end = len(l) - 1
-    line_end_new = l.find(' ', line_start)  # comma's always have a space before them
+        extend_flat(array_data)
 
-    if line_end_new != -1:
-        line_end = line_end_new
+    # We requested a flat array
+    if group == 0:
+        return flat_array
 
-    try:
-        float(l[line_start:line_end])  # works for a float or int
-        return True
-    except:
-        return False
+    new_array = []
+    sub_array = []
+
+    for item in flat_array:
+        sub_array.append(item)
+        if len(sub_array) == group:
+            new_array.append(sub_array)
+            sub_array = []
+
+    if sub_array:
+        print('\twarning, array was not aligned to requested grouping', group, 'remaining value', sub_array)
+
+    return new_array
+
+
+# The field_index of all the nodes with no fields, it is only read
+EMPTY_FIELD_INDEX = types.MappingProxyType({})
 
 
 class vrmlNode(object):
@@ -307,11 +694,9 @@ class vrmlNode(object):
                  'fields',
                  'proto_node',
                  'proto_field_defs',
-                 'proto_fields',
                  'node_type',
                  'parent',
                  'children',
-                 'parent',
                  'array_data',
                  'reference',
                  'lineno',
@@ -321,7 +706,10 @@ class vrmlNode(object):
                  'ROUTE_IPO_NAMESPACE',
                  'PROTO_NAMESPACE',
                  'x3dNode',
-                 'parsed')
+                 'parsed',
+                 'field_index',
+                 'proto_lookup_cache',
+                 'buffer_cache')
 
     def __init__(self, parent, node_type, lineno):
         self.id = None
@@ -351,15 +739,20 @@ class vrmlNode(object):
 
         self.reference = None
 
+        self.field_index = None  # set by parse(), see indexFields()
+        self.proto_lookup_cache = None  # see getProtoFieldLookup()
+        self.buffer_cache = None  # see getFieldAsBuffer()
+
         if node_type == NODE_REFERENCE:
             # For references, only the parent and ID are needed
             # the reference its self is assigned on parsing
             return
 
-        self.fields = []  # fields have no order, in some cases rool level values are not unique so dont use a dict
+        # fields have no order, in some cases rool level values are not unique so dont use a dict
+        # A tuple of vrmlField()s once parsed, empty ones all share ()
+        self.fields = []
 
         self.proto_field_defs = []  # proto field definition eg: "field SFColor seatColor .6 .6 .1"
-        self.proto_fields = []  # proto field usage "diffuseColor IS seatColor"
         self.children = []
         self.array_data = []  # use for arrays of data - should only be for NODE_ARRAY types
 
@@ -441,6 +834,8 @@ class vrmlNode(object):
 
     def getSpecialTypeName(self, typename):
         self_real = self.getRealNode()
+        if not self_real.id:
+            return None  # x3d nodes, cheaper than the exception
         try:
             return self_real.id[list(self_real.id).index(typename) + 1]
         except:
@@ -496,35 +891,55 @@ class vrmlNode(object):
                 return child
 
     def getSerialized(self, results, ancestry):
-        """ Return this node and all its children in a flat list """
-        ancestry = ancestry[:]  # always use a copy
-
-        # self_real = self.getRealNode()
-
-        results.append((self, tuple(ancestry)))
-        ancestry.append(self)
-        for child in self.getRealNode().children:
-            if child not in ancestry:
-                # We dont want to load proto's, they are only references
-                # We could enforce this elsewhere
-
-                # Only add this in a very special case
-                # where the parent of this object is not the real parent
-                # - In this case we have added the proto as a child to a node instancing it.
-                # This is a bit arbitary, but its how Proto's are done with this importer.
-                if child.getProtoName() is None and child.getExternprotoName() is None:
-                    child.getSerialized(results, ancestry)
-                else:
+        """
+        Return this node and all its children in a flat list of
+        (node, ancestry) pairs, depth first.
+        The ancestry is a tuple made once per parent and shared by all its
+        children, so the list costs one tuple per node with children rather
+        than one per node.
+        """
+        ancestry = tuple(ancestry)
+        on_path = set(ancestry)  # a node under itself is a cycle, eg: USE inside its DEF
+
+        # None entries mark leaving a node, all its children have been done then
+        stack = [(self, ancestry)]
+        while stack:
+            node, ancestry = stack.pop()
+            if node is None:
+                on_path.remove(ancestry)
+                continue
 
-                    if DEBUG:
-                        print('getSerialized() is proto:', child.getProtoName(), child.getExternprotoName(), self.getSpec())
+            results.append((node, ancestry))
+            on_path.add(node)
+            stack.append((None, node))
+
+            node_ancestry = ancestry + (node,)
+            children = []
+            for child in node.getRealNode().children:
+                if child not in on_path:
+                    # We dont want to load proto's, they are only references
+                    # We could enforce this elsewhere
+
+                    # Only add this in a very special case
+                    # where the parent of this object is not the real parent
+                    # - In this case we have added the proto as a child to a node instancing it.
+                    # This is a bit arbitary, but its how Proto's are done with this importer.
+                    if child.getProtoName() is None and child.getExternprotoName() is None:
+                        children.append(child)
+                    else:
+
+                        if DEBUG:
+                            print('getSerialized() is proto:', child.getProtoName(), child.getExternprotoName(), node.getSpec())
 
-                    self_spec = self.getSpec()
+                        node_spec = node.getSpec()
 
-                    if child.getProtoName() == self_spec or child.getExternprotoName() == self_spec:
-                        #if DEBUG:
-                        #    "FoundProto!"
-                        child.getSerialized(results, ancestry)
+                        if child.getProtoName() == node_spec or child.getExternprotoName() == node_spec:
+                            #if DEBUG:
+                            #    "FoundProto!"
+                            children.append(child)
+
+            # Reversed, the first child comes off the stack first
+            stack.extend([(child, node_ancestry) for child in reversed(children)])
 
         return results
 
@@ -537,81 +952,116 @@ class vrmlNode(object):
             child.searchNodeTypeID(node_spec, results)
         return results
 
+    def indexFields(self):
+        """
+        Map field names to fields, and array children to their name (eg: 'point [ ... ]'),
+        so getFieldName doesn't have to search the whole node for every lookup.
+        Fields win over children and the first of a name wins, the same as searching in order.
+        """
+        index = {}
+        for f in self.fields:
+            if f and f[0] not in index:
+                index[f[0]] = f
+
+        for child in self.children:
+            if child.id and len(child.id) == 1 and child.id[0] not in index:
+                index[child.id[0]] = child
+
+        return index or EMPTY_FIELD_INDEX
+
     def getFieldName(self, field, ancestry, AS_CHILD=False, SPLIT_COMMAS=False):
         self_real = self.getRealNode()  # in case we're an instance
 
-        for f in self_real.fields:
-            # print(f)
-            if f and f[0] == field:
-                # print('\tfound field', f)
-
-                if len(f) >= 3 and f[1] == 'IS':  # eg: 'diffuseColor IS legColor'
-                    field_id = f[2]
-
-                    # print("\n\n\n\n\n\nFOND IS!!!")
-                    f_proto_lookup = None
-                    f_proto_child_lookup = None
-                    i = len(ancestry)
-                    while i:
-                        i -= 1
-                        node = ancestry[i]
-                        node = node.getRealNode()
-
-                        # proto settings are stored in "self.proto_node"
-                        if node.proto_node:
-                            # Get the default value from the proto, this can be overwridden by the proto instace
-                            # 'field SFColor legColor .8 .4 .7'
-                            if AS_CHILD:
-                                for child in node.proto_node.children:
-                                    #if child.id  and  len(child.id) >= 3  and child.id[2]==field_id:
-                                    if child.id and ('point' in child.id or 'points' in child.id):
-                                        f_proto_child_lookup = child
+        index = self_real.field_index
+        if index is None:
+            # Still being parsed, eg: a USE of one of its own parents
+            index = self_real.indexFields()
 
-                            else:
-                                for f_def in node.proto_node.proto_field_defs:
-                                    if len(f_def) >= 4:
-                                        if f_def[0] == 'field' and f_def[2] == field_id:
-                                            f_proto_lookup = f_def[3:]
-
-                        # Node instance, Will be 1 up from the proto-node in the ancestry list. but NOT its parent.
-                        # This is the setting as defined by the instance, including this setting is optional,
-                        # and will override the default PROTO value
-                        # eg: 'legColor 1 0 0'
-                        if AS_CHILD:
-                            for child in node.children:
-                                if child.id and child.id[0] == field_id:
-                                    f_proto_child_lookup = child
-                        else:
-                            for f_def in node.fields:
-                                if len(f_def) >= 2:
-                                    if f_def[0] == field_id:
-                                        if DEBUG:
-                                            print("getFieldName(), found proto", f_def)
-                                        f_proto_lookup = f_def[1:]
+        f = index.get(field)
+        if f is None:
+            # print('\tfield not found', field)
+            return None
 
-                    if AS_CHILD:
-                        if f_proto_child_lookup:
+        # See if this is a proto name
+        if isinstance(f, vrmlNode):
+            if AS_CHILD:
+                return f
+            return None
+
+        # print('\tfound field', f)
+        if len(f) >= 3 and f[1] == 'IS':  # eg: 'diffuseColor IS legColor'
+            f_proto_lookup = self_real.getProtoFieldLookup(f[2], ancestry, AS_CHILD)
+            if f_proto_lookup is None or AS_CHILD:
+                return f_proto_lookup
+            return f_proto_lookup[:]  # the caller may change it
+        else:
+            if AS_CHILD:
+                return None
+            else:
+                # Not using a proto
+                return f[1:]
+
+    def getProtoFieldLookup(self, field_id, ancestry, AS_CHILD):
+        """
+        Resolve a field of a PROTO body from the instance in the ancestry, eg: 'legColor 1 0 0',
+        or from the PROTO default. The body is shared by all instances so the result is
+        remembered per instance, for nested PROTO's per instance of each of them.
+        """
+        # Node instance, Will be 1 up from the proto-node in the ancestry list. but NOT its parent.
+        # PROTO nodes are never USE'd, their instances can be
+        protos = [(node, ancestry[i - 1].getRealNode())
+                  for i, node in enumerate(ancestry) if node.proto_node and i]
+
+        key = (field_id, AS_CHILD) + tuple(instance for proto, instance in protos)
+        if self.proto_lookup_cache is None:
+            self.proto_lookup_cache = {}
+        elif key in self.proto_lookup_cache:
+            return self.proto_lookup_cache[key]
+
+        # print("\n\n\n\n\n\nFOND IS!!!")
+        f_proto_lookup = None
+        f_proto_child_lookup = None
+        # Outer instances last, they can set what the inner ones pass on with IS
+        for proto, node in reversed(protos):
+            # proto settings are stored in "self.proto_node"
+            # Get the default value from the proto, this can be overwridden by the proto instace
+            # 'field SFColor legColor .8 .4 .7'
+            if AS_CHILD:
+                for child in proto.proto_node.children:
+                    #if child.id  and  len(child.id) >= 3  and child.id[2]==field_id:
+                    if child.id and ('point' in child.id or 'points' in child.id):
+                        f_proto_child_lookup = child
+
+            else:
+                for f_def in proto.proto_node.proto_field_defs:
+                    if len(f_def) >= 4:
+                        if f_def[0] == 'field' and f_def[2] == field_id:
+                            f_proto_lookup = f_def[3:]
+
+            # This is the setting as defined by the instance, including this setting is optional,
+            # and will override the default PROTO value
+            # eg: 'legColor 1 0 0'
+            if AS_CHILD:
+                for child in node.children:
+                    if child.id and child.id[0] == field_id:
+                        f_proto_child_lookup = child
+            else:
+                for f_def in node.fields:
+                    if len(f_def) >= 2:
+                        if f_def[0] == field_id:
                             if DEBUG:
-                                print("getFieldName() - AS_CHILD=True, child found")
-                                print(f_proto_child_lookup)
-                        return f_proto_child_lookup
-                    else:
-                        return f_proto_lookup
-                else:
-                    if AS_CHILD:
-                        return None
-                    else:
-                        # Not using a proto
-                        return f[1:]
-        # print('\tfield not found', field)
+                                print("getFieldName(), found proto", f_def)
+                            f_proto_lookup = f_def[1:]
 
-        # See if this is a proto name
         if AS_CHILD:
-            for child in self_real.children:
-                if child.id and len(child.id) == 1 and child.id[0] == field:
-                    return child
+            if f_proto_child_lookup:
+                if DEBUG:
+                    print("getFieldName() - AS_CHILD=True, child found")
+                    print(f_proto_child_lookup)
+            f_proto_lookup = f_proto_child_lookup
 
-        return None
+        self.proto_lookup_cache[key] = f_proto_lookup
+        return f_proto_lookup
 
     def getFieldAsInt(self, field, default, ancestry):
         self_real = self.getRealNode()  # in case we're an instance
@@ -626,11 +1076,16 @@ class vrmlNode(object):
             print('\t"%s" wrong length for int conversion for field "%s"' % (f, field))
             return default
 
-        try:
-            return int(f[0])
-        except:
-            print('\tvalue "%s" could not be used as an int for field "%s"' % (f[0], field))
-            return default
+        # vrmlField already converted it, if it could be, X3D values are still text
+        if type(f[0]) == int:
+            return f[0]
+        if type(f[0]) == str:
+            try:
+                return int(f[0])
+            except ValueError:
+                pass
+        print('\tvalue "%s" could not be used as an int for field "%s"' % (f[0], field))
+        return default
 
     def getFieldAsFloat(self, field, default, ancestry):
         self_real = self.getRealNode()  # in case we're an instance
@@ -691,9 +1146,10 @@ class vrmlNode(object):
             print('\t"%s" wrong length for bool conversion for field "%s"' % (f, field))
             return default
 
-        if f[0].upper() == '"TRUE"' or f[0].upper() == 'TRUE':
+        value = str(f[0]).upper()
+        if value == '"TRUE"' or value == 'TRUE':
             return True
-        elif f[0].upper() == '"FALSE"' or f[0].upper() == 'FALSE':
+        elif value == '"FALSE"' or value == 'FALSE':
             return False
         else:
             print('\t"%s" could not be used as a bool for field "%s"' % (f[1], field))
@@ -711,9 +1167,9 @@ class vrmlNode(object):
 
         if len(f) > 1:
             # String may contain spaces
-            st = ' '.join(f)
+            st = ' '.join(map(str, f))
         else:
-            st = f[0]
+            st = str(f[0])
 
         # X3D HACK
         if self.x3dNode:
@@ -725,15 +1181,17 @@ class vrmlNode(object):
             print('\tvalue "%s" could not be used as a string for field "%s"' % (f[0], field))
             return default
 
-    def getFieldAsArray(self, field, group, ancestry):
+    def getFieldArrayData(self, field, ancestry):
         """
-        For this parser arrays are children
+        The array data for a field as it was parsed, a flat numpy array
+        for blocks of numbers that could be decoded at once,
+        otherwise a list, possibly nested.
         """
 
         def array_as_number(array_string):
             array_data = []
             try:
-                array_data = [int(val, 0) for val in array_string]
+                array_data = [val if type(val) == int else int(val, 0) for val in array_string]
             except:
                 try:
                     array_data = [float(val) for val in array_string]
@@ -756,59 +1214,84 @@ class vrmlNode(object):
             if not data_split:
                 return []
 
-            array_data = array_as_number(data_split)
+            return array_as_number(data_split)
 
         elif type(child_array) == list:
             # x3d creates these
-            array_data = array_as_number(child_array)
+            return array_as_number(child_array)
         else:
             # print(child_array)
             # Normal vrml
-            array_data = child_array.array_data
+            if type(child_array.array_data) == str:
+                child_array.decodeArrayData()
+            return child_array.array_data
 
-        # print('array_data', array_data)
-        if group == -1 or len(array_data) == 0:
-            return array_data
-
-        # We want a flat list
-        flat = True
-        for item in array_data:
-            if type(item) == list:
-                flat = False
-                break
-
-        # make a flat array
-        if flat:
-            flat_array = array_data  # we are already flat.
-        else:
-            flat_array = []
+    def decodeArrayData(self):
+        """
+        Decode a number block the parser kept as text, so the parts of a
+        file the importer never looks at are not converted at all.
+        """
+        text = self.array_data
+        array_data = vrmlDecodeNumbers(text)
+        if array_data is None:
+            # Numbers numpy can't read (eg: '1.2.3'), do each line as the parser would,
+            # except lines that don't start with a number, they would have been fields.
+            array_data = []
+            for l in text.split('\n'):
+                if vrmlIsNumline(l):
+                    values = vrmlLineValues(l)
+                    if values:
+                        array_data.extend(values)
 
-            def extend_flat(ls):
-                for item in ls:
-                    if type(item) == list:
-                        extend_flat(item)
-                    else:
-                        flat_array.append(item)
+        self.array_data = array_data
 
-            extend_flat(array_data)
+    def getFieldAsArray(self, field, group, ancestry):
+        """
+        For this parser arrays are children
+        """
+        array_data = self.getFieldArrayData(field, ancestry)
 
-        # We requested a flat array
-        if group == 0:
-            return flat_array
+        if type(array_data) == np.ndarray:
+            return groupBuffer(array_data, group).tolist()
 
-        new_array = []
-        sub_array = []
+        return groupArray(array_data, group)
 
-        for item in flat_array:
-            sub_array.append(item)
-            if len(sub_array) == group:
-                new_array.append(sub_array)
-                sub_array = []
+    def getFieldAsBuffer(self, field, group, ancestry, dtype=None):
+        """
+        Same as getFieldAsArray but returns a numpy array, flat or with
+        rows of group items. Pass a dtype to get the buffer layout Blender's
+        foreach_set expects (np.float32 for coordinates, np.int32 for indices).
 
-        if sub_array:
-            print('\twarning, array was not aligned to requested grouping', group, 'remaining value', sub_array)
+        A DEF'd node (a Coordinate shared by many meshes...) keeps the buffer
+        once it had to be converted, every USE gets views of the same array.
+        The buffer is shared, don't modify it.
+        """
+        array_data = self.getFieldArrayData(field, ancestry)
 
-        return new_array
+        self_real = self.getRealNode()  # in case we're an instance
+        key = (field, dtype)
+        if self_real.buffer_cache is not None and key in self_real.buffer_cache:
+            source, buffer = self_real.buffer_cache[key]
+            if source is array_data:  # PROTO fields may resolve to other data
+                return groupBuffer(buffer, group)
+
+        buffer = array_data
+        if type(buffer) != np.ndarray:
+            buffer = np.array(groupArray(buffer, 0))
+            if buffer.dtype.kind not in 'iuf':
+                if len(buffer):
+                    print('\tWarning, field "%s" could not be used as a numeric array' % field)
+                buffer = np.zeros(0, dtype=np.float32)
+
+        if dtype is not None:
+            buffer = buffer.astype(dtype, copy=False)
+
+        if buffer is not array_data and self_real.canHaveReferences():
+            if self_real.buffer_cache is None:
+                self_real.buffer_cache = {}
+            self_real.buffer_cache[key] = (array_data, buffer)
+
+        return groupBuffer(buffer, group)
 
     def getFieldAsStringArray(self, field, ancestry):
         """
@@ -895,8 +1378,12 @@ class vrmlNode(object):
 
         return text
 
-    def parse(self, i, IS_PROTO_DATA=False):
-        new_i = self.__parse(i, IS_PROTO_DATA)
+    def parse(self, ctx, i, IS_PROTO_DATA=False):
+        new_i = self.__parse(ctx, i, IS_PROTO_DATA)
+        if self.node_type != NODE_REFERENCE:
+            self.fields = tuple(self.fields)
+            self.proto_field_defs = tuple(self.proto_field_defs)
+            self.field_index = self.indexFields()
 
         # print(self.id, self.getFilename())
 
@@ -920,6 +1407,8 @@ class vrmlNode(object):
                     f = [f]
 
                 for ff in f:
+                    if type(ff) != str:
+                        continue  # a number, not a url
                     for f_split in ff.split('"'):
                         # print(f_split)
                         # "someextern.vrml#SomeID"
@@ -940,13 +1429,13 @@ class vrmlNode(object):
                 print(url)
                 urls = []
                 urls.append(url)
-                urls.append(bpy.path.resolve_ncase(urls[-1]))
+                urls.append(resolveNCase(urls[-1]))
 
                 urls.append(os.path.join(os.path.dirname(self.getFilename()), url))
-                urls.append(bpy.path.resolve_ncase(urls[-1]))
+                urls.append(resolveNCase(urls[-1]))
 
                 urls.append(os.path.join(os.path.dirname(self.getFilename()), os.path.basename(url)))
-                urls.append(bpy.path.resolve_ncase(urls[-1]))
+                urls.append(resolveNCase(urls[-1]))
 
                 try:
                     url = [url for url in urls if os.path.exists(url)][0]
@@ -961,32 +1450,32 @@ class vrmlNode(object):
                         print('\tWarning: cant Inline yourself recursively:', url)
                     else:
 
+                        inline_lines = None
+                        chunks = web3dChunks(url, ctx.stats)
                         try:
-                            data = gzipOpen(url)
-                        except:
+                            if chunks is not None:
+                                with ctx.stats.phase('tokenize'):
+                                    inline_lines = list(vrmlTokenize(chunks))
+                        except READ_ERRORS:
+                            pass
+
+                        if inline_lines is None:
                             print('\tWarning: cant open the file:', url)
-                            data = None
 
-                        if data:
+                        elif inline_lines:
                             # Tricky - inline another VRML
                             print('\tLoading Inline:"%s"...' % url)
 
-                            # Watch it! - backup lines
-                            lines_old = lines[:]
-
-                            lines[:] = vrmlFormat(data)
-
-                            lines.insert(0, '{')
-                            lines.insert(0, 'root_node____')
-                            lines.append('}')
+                            # The inline gets its own context, ours stays as it is
+                            inline_ctx = vrmlParseContext(['root_node____', '{'] + inline_lines + ['}'], ctx.stats)
                             '''
                             ff = open('/tmp/test.txt', 'w')
-                            ff.writelines([l+'\n' for l in lines])
+                            ff.writelines([l+'\n' for l in inline_ctx.lines])
                             '''
 
                             child = vrmlNode(self, NODE_NORMAL, -1)
                             child.setRoot(url)  # initialized dicts
-                            child.parse(0)
+                            child.parse(inline_ctx, 0)
 
                             # if self.getExternprotoName():
                             if self.getExternprotoName():
@@ -1009,16 +1498,14 @@ class vrmlNode(object):
                                     else:
                                         print("\tEXTERNPROTO ID not found!:", extern_key)
 
-                            # Watch it! - restore lines
-                            lines[:] = lines_old
-
         return new_i
 
-    def __parse(self, i, IS_PROTO_DATA=False):
+    def __parse(self, ctx, i, IS_PROTO_DATA=False):
         '''
         print('parsing at', i, end="")
         print(i, self.id, self.lineno)
         '''
+        lines = ctx.lines
         l = lines[i]
 
         if l == '[':
@@ -1028,7 +1515,7 @@ class vrmlNode(object):
         else:
             words = []
 
-            node_type, new_i = is_nodeline(i, words)
+            node_type, new_i = ctx.is_nodeline(i, words)
             if not node_type:  # fail for parsing new node.
                 print("Failed to parse new node")
                 raise ValueError
@@ -1036,12 +1523,12 @@ class vrmlNode(object):
             if self.node_type == NODE_REFERENCE:
                 # Only assign the reference and quit
                 key = words[words.index('USE') + 1]
-                self.id = (words[0],)
+                self.id = (sys.intern(words[0]),)
 
                 self.reference = self.getDefDict()[key]
                 return new_i
 
-            self.id = tuple(words)
+            self.id = tuple(map(sys.intern, words))
 
             # fill in DEF/USE
             key = self.getDefName()
@@ -1058,7 +1545,7 @@ class vrmlNode(object):
 
                 # Parse the proto nodes fields
                 self.proto_node = vrmlNode(self, NODE_ARRAY, new_i)
-                new_i = self.proto_node.parse(new_i)
+                new_i = self.proto_node.parse(ctx, new_i)
 
                 self.children.remove(self.proto_node)
 
@@ -1107,36 +1594,25 @@ class vrmlNode(object):
                 ### print("returning", i)
                 return i + 1
 
-            node_type, new_i = is_nodeline(i, [])
+            node_type, new_i = ctx.is_nodeline(i, [])
             if node_type:  # check text\n{
                 child = vrmlNode(self, node_type, i)
-                i = child.parse(i)
+                i = child.parse(ctx, i)
 
             elif l == '[':  # some files have these anonymous lists
                 child = vrmlNode(self, NODE_ARRAY, i)
-                i = child.parse(i)
-
-            elif is_numline(i):
-                l_split = l.split(',')
+                i = child.parse(ctx, i)
 
-                values = None
-                # See if each item is a float?
-
-                for num_type in (int, float):
-                    try:
-                        values = [num_type(v) for v in l_split]
-                        break
-                    except:
-                        pass
-
-                    try:
-                        values = [[num_type(v) for v in segment.split()] for segment in l_split]
-                        break
-                    except:
-                        pass
+            elif ctx.is_numline(i):
+                if self.node_type == NODE_ARRAY and not self.array_data:
+                    # Nearly always the whole block is numbers, decode it at once (or on first use).
+                    array_data, new_i = ctx.decodeBlock(i)
+                    if array_data is not None:
+                        self.array_data = array_data
+                        i = new_i
+                        continue
 
-                if values is None:  # dont parse
-                    values = l_split
+                values = vrmlLineValues(l)
 
                 # This should not extend over multiple lines however it is possible
                 # print(self.array_data)
@@ -1213,6 +1689,7 @@ class vrmlNode(object):
                     for value in split_fields(value_all):
                         # Split
 
+                        value = vrmlField(value)
                         if value[0] == 'field':
                             # field SFFloat creaseAngle 4
                             self.proto_field_defs.append(value)
@@ -1224,192 +1701,878 @@ class vrmlNode(object):
     def canHaveReferences(self):
         return self.node_type == NODE_NORMAL and self.getDefName()
 
-    # This is a prerequisite for raw XML-based material caching. For now, only for X3D
-    def desc(self):
+
+def resolveNCase(path):
+    # Case insensitive path lookup, only available in Blender.
+    if bpy is None:
+        return path
+    return bpy.path.resolve_ncase(path)
+
+
+GZIP_MAGIC = b'\x1f\x8b'
+READ_CHUNK_SIZE = 1 << 20
+
+# Reading a file that turns out to be broken half way, eg: a truncated .wrl.gz
+READ_ERRORS = (OSError, EOFError, zlib.error)
+
+
+def web3dChunks(path, stats=NO_STATS):
+    """
+    Read a plain or gzipped file as text, a chunk at a time, for vrmlTokenize and the X3D reader.
+    Gzip is detected from the first bytes, plain files are memory mapped.
+    Returns an iterator of strings or None when the file can't be opened,
+    iterating may raise one of READ_ERRORS. Reading is timed in stats.
+    """
+    try:
+        f = open(path, 'rb')
+        magic = f.read(2)
+        f.seek(0)
+    except OSError:
+        return None
+
+    if magic == GZIP_MAGIC:
+        raw = gzip.GzipFile(fileobj=f, mode='rb')
+    elif magic:
+        raw = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    else:
+        raw = f  # can't map an empty file
+
+    return web3dReadChunks(f, raw, stats)
+
+
+def web3dReadChunks(f, raw, stats):
+    # utf-8 as gzip files always were, with the universal newlines plain files had
+    decoder = io.IncrementalNewlineDecoder(codecs.getincrementaldecoder('utf-8')('replace'), True)
+    try:
+        while True:
+            stats.start('read')
+            try:
+                data = raw.read(READ_CHUNK_SIZE)
+                text = decoder.decode(data, not data)
+            finally:
+                stats.stop()
+            if text:
+                yield text
+            if not data:
+                break
+    finally:
+        if raw is not f:
+            raw.close()
+        f.close()
+
+
+def vrml_parse(path, stats=NO_STATS):
+    """
+    Sets up the root node and returns it so load_web3d() can deal with the blender side of things.
+    Return root (vrmlNode, '') or (None, 'Error String')
+    The phases are timed in stats, an importStats.
+    """
+    chunks = web3dChunks(path, stats)
+
+    if chunks is None:
+        return None, 'Failed to open file: ' + path
+
+    try:
+        with stats.phase('tokenize'):
+            lines = list(vrmlTokenize(chunks))
+    except READ_ERRORS:
+        return None, 'Failed to read file: ' + path
+
+    # Stripped above
+    # Trick to make sure we get all root nodes, root_node____ is put around dymmy_node.
+    # important the name starts with an ascii char
+    ctx = vrmlParseContext(['root_node____', '{', 'dymmy_node', '{'] + lines + ['}', '}'], stats)
+    del lines
+    # Use for testing our parsed output, so we can check on line numbers.
+
+    '''
+    ff = open('/tmp/test.txt', 'w')
+    ff.writelines([l+'\n' for l in ctx.lines])
+    ff.close()
+    '''
+
+    # Now evaluate it
+    node_type, new_i = ctx.is_nodeline(2, [])
+    if not node_type:
+        return None, 'Error: VRML file has no starting Node'
+
+    root = vrmlNode(None, NODE_NORMAL, -1)
+    root.setRoot(path)  # we need to set the root so we have a namespace and know the path in case of inlineing
+
+    # Parse recursively
+    with stats.phase('parse'):
+        root.parse(ctx, 0)
+
+    # This prints a load of text
+    if DEBUG:
+        print(root)
+
+    return root, ''
+
+
+# ====================== END VRML
+
+# ====================== X3d Support
+
+class x3dElement(object):
+    """
+    The tag and attributes of an X3D element, all the importer needs from the XML.
+    Much smaller than a DOM element, there are no text, comment or attribute nodes.
+    """
+    __slots__ = ('tagName', 'attributes', 'blob_attributes')
+
+    def __init__(self, tagName, attributes, blob_attributes=None):
+        self.tagName = tagName
+        self.attributes = attributes
+        # Long values of an element from the scene cache, {name: (blob, offset, byte count)}
+        self.blob_attributes = blob_attributes
+
+    def getAttribute(self, name):
+        # None when not set, '' is a valid value
+        value = self.attributes.get(name)
+        if value is None and self.blob_attributes and name in self.blob_attributes:
+            # Only decoded when read, the importer mostly wants the arrays in array_cache
+            blob, offset, count = self.blob_attributes.pop(name)
+            value = self.attributes[name] = blob[offset:offset + count].decode('utf-8')
+        return value
+
+    def attributeNames(self):
+        return list(self.attributes) + list(self.blob_attributes or ())
+
+
+# Sane as vrml but replace the parser
+class x3dNode(vrmlNode):
+    __slots__ = ('array_cache',)
+
+    def __init__(self, parent, node_type, x3dNode):
+        vrmlNode.__init__(self, parent, node_type, -1)
+        self.x3dNode = x3dNode
+        self.fields = self.proto_field_defs = ()  # the attributes are its fields
+        self.array_cache = None  # decoded numeric attributes, see getFieldArrayData()
+
+    def parse(self, IS_PROTO_DATA=False):
+        """
+        Deal with DEF/USE of this element, x3d_parse adds the children as the XML is read.
+        Returns False when the children must be skipped.
+        """
+        # print(self.x3dNode.tagName)
+
+        define = self.x3dNode.getAttribute('DEF')
+        if define is not None:
+            self.getDefDict()[define] = self
+        else:
+            use = self.x3dNode.getAttribute('USE')
+            if use is not None:
+                try:
+                    self.reference = self.getDefDict()[use]
+                    self.node_type = NODE_REFERENCE
+                except:
+                    print('\tWarning: reference', use, 'not found')
+                    self.parent.children.remove(self)
+
+                return False
+
+        # TODO - x3d Inline
+
+        return True
+
+    def getSpec(self):
+        return self.x3dNode.tagName  # should match vrml spec
+
+    def getDefName(self):
+        data = self.x3dNode.getAttribute('DEF')
+        if data:
+            data  # XXX, return??
+        return None
+
+    # Other funcs operate from vrml, but this means we can wrap XML fields, still use nice utility funcs
+    # getFieldAsArray getFieldAsBool etc
+    def getFieldName(self, field, ancestry, AS_CHILD=False, SPLIT_COMMAS=False):
+        # ancestry and AS_CHILD are ignored, only used for VRML now
+
+        self_real = self.getRealNode()  # in case we're an instance
+        value = self.x3dNode.getAttribute(field)
+        if value is not None:
+            # We may want to edit. for x3d specific stuff
+            # Sucks a bit to return the field name in the list but vrml excepts this :/
+            if SPLIT_COMMAS:
+                value = value.replace(",", " ")
+            return value.split()
+        else:
+            return None
+
+    def getFieldArrayData(self, field, ancestry):
+        """
+        Numeric attributes (point, coordIndex, color...) are decoded in one go
+        and kept on the node, reading them again costs nothing.
+        The array is shared, don't modify it.
+        """
+        self_real = self.getRealNode()  # in case we're an instance
+
+        if self_real.array_cache is None:
+            self_real.array_cache = {}
+        elif field in self_real.array_cache:
+            return self_real.array_cache[field]
+
+        value = self_real.x3dNode.getAttribute(field)
+        if value is None:
+            # Only a USE could have it, not worth keeping
+            return vrmlNode.getFieldArrayData(self, field, ancestry)
+
+        array_data = vrmlDecodeNumbers(value)
+        if array_data is None:
+            # eg: hex PixelTexture values, these are converted one by one
+            array_data = vrmlNode.getFieldArrayData(self_real, field, ancestry)
+
+        self_real.array_cache[field] = array_data
+        return array_data
+
+    def canHaveReferences(self):
+        return self.x3dNode.getAttribute('DEF') is not None
+
+
+def x3d_parse(path, stats=NO_STATS):
+    """
+    Sets up the root node and returns it so load_web3d() can deal with the blender side of things.
+    Return root (x3dNode, '') or (None, 'Error String')
+    The phases are timed in stats, an importStats.
+
+    The XML is read with expat, nodes are made as their elements are read so there is no DOM.
+    """
+
+    try:
+        import xml.parsers.expat
+    except:
+        return None, 'Error, import XML parsing module (xml.parsers.expat) failed, install python'
+
+    chunks = web3dChunks(path, stats)
+
+    if chunks is None:
+        return None, 'Failed to open file: ' + path
+
+    root = None
+    nodes = []  # the node of every open element, None for skipped ones (outside X3D, inside a USE)
+
+    def start_element(name, attributes):
+        nonlocal root
+
+        if root is None and name == 'X3D':
+            root = x3dNode(None, NODE_NORMAL, x3dElement(name, attributes))
+            root.setRoot(path)  # so images and Inline's we load have a relative path
+            nodes.append(root)
+            return
+
+        parent = nodes[-1] if nodes else None
+        if parent is None:
+            nodes.append(None)
+            return
+
+        node_type = NODE_NORMAL
+        if 'USE' in attributes:
+            node_type = NODE_REFERENCE
+
+        child = x3dNode(parent, node_type, x3dElement(name, attributes))
+        if child.parse():
+            nodes.append(child)
+        else:
+            nodes.append(None)
+
+    def end_element(name):
+        nodes.pop()
+
+    parser = xml.parsers.expat.ParserCreate()
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    try:
+        with stats.phase('parse'):
+            for chunk in chunks:
+                parser.Parse(chunk, False)
+            parser.Parse('', True)
+    except READ_ERRORS + (xml.parsers.expat.ExpatError,):
+        return None, 'Failed to read file: ' + path
+
+    if root is None:
+        return None, 'Not a valid x3d document, cannot import'
+
+    return root, ''
+
+# ====================== Scene cache
+
+def fileDigest(paths):
+    """
+    Hash of the contents of the files, None when one can't be read.
+    """
+    sha = hashlib.sha1()
+    try:
+        for file_path in paths:
+            f = open(file_path, 'rb')
+            while True:
+                chunk = f.read(1 << 20)
+                if not chunk:
+                    break
+                sha.update(chunk)
+            f.close()
+    except OSError:
+        return None
+
+    return sha.hexdigest()
+
+
+def sceneCacheKey(path):
+    """
+    Hash of the file and of this importer, any change to either gives a new key.
+    Returns None when the file can't be read.
+    """
+    return fileDigest((__file__, path))
+
+
+def sceneCacheSave(path, root):
+    """
+    Write the node tree to the cache, the structure as json and the arrays in a flat
+    binary file next to it, so sceneCacheLoad can memory map them.
+    Scenes with Inline's or EXTERNPROTO's are not kept, they depend on other files.
+    Returns True when the scene was written.
+    """
+    if not SCENE_CACHE_DIR:
+        return False
+
+    key = sceneCacheKey(path)
+    if key is None:
+        return False
+
+    # Number the nodes, the tree has shared nodes (PROTO's) so links are stored as indices
+    nodes = []
+    node_index = {}
+    stack = [root]
+    stack.extend(root.DEF_NAMESPACE.values())
+    stack.extend(root.PROTO_NAMESPACE.values())
+    while stack:
+        node = stack.pop()
+        if id(node) in node_index:
+            continue
+
+        if node is not root and node.filename is not None:
+            return False
+
+        node_index[id(node)] = len(nodes)
+        nodes.append(node)
+
+        for linked in (node.parent, node.reference, node.proto_node):
+            if linked is not None:
+                stack.append(linked)
+        # References have no children
+        stack.extend(getattr(node, 'children', ()))
+
+    blob = []
+    blob_size = 0
+
+    def store(data):
+        # Arrays and array text go in the binary file, anything else in the json
+        nonlocal blob_size
+        if type(data) == np.ndarray:
+            ref = {'dtype': data.dtype.str, 'offset': blob_size, 'count': len(data)}
+            raw = data.tobytes()
+        elif type(data) == str:
+            raw = data.encode('utf-8')
+            ref = {'text': blob_size, 'count': len(raw)}
+        else:
+            return data
+
+        blob.append(raw)
+        blob_size += len(raw)
+        pad = -blob_size % 8  # keep every array aligned
+        if pad:
+            blob.append(b'\0' * pad)
+            blob_size += pad
+        return ref
+
+    records = []
+    for node in nodes:
+        record = {'node_type': node.node_type, 'lineno': node.lineno}
+        if node.parent is not None:
+            record['parent'] = node_index[id(node.parent)]
+        if node.id is not None:
+            record['id'] = list(node.id)
+        if node.reference is not None:
+            record['reference'] = node_index[id(node.reference)]
+        if node.proto_node is not None:
+            record['proto_node'] = node_index[id(node.proto_node)]
+
+        if node.x3dNode:
+            record['tag'] = node.x3dNode.tagName
+            # Coordinates and indices go in the binary file, the json stays small
+            attributes = record['attributes'] = {}
+            for name in node.x3dNode.attributeNames():
+                value = node.x3dNode.getAttribute(name)
+                if len(value) > 256:
+                    record.setdefault('blob_attributes', {})[name] = store(value)
+                else:
+                    attributes[name] = value
+            if node.array_cache:
+                record['array_cache'] = {field: store(value) for field, value in node.array_cache.items()}
+
+        if hasattr(node, 'children'):
+            record['children'] = [node_index[id(child)] for child in node.children]
+            record['fields'] = node.fields
+            record['proto_field_defs'] = node.proto_field_defs
+            record['array_data'] = store(node.array_data)
+
+        records.append(record)
+
+    index = {'nodes': records,
+             'root': node_index[id(root)],
+             'DEF': {key: node_index[id(node)] for key, node in root.DEF_NAMESPACE.items()},
+             'PROTO': {key: node_index[id(node)] for key, node in root.PROTO_NAMESPACE.items()},
+             }
+
+    # Write under temporary names first, so an other Blender never reads half a file
+    os.makedirs(SCENE_CACHE_DIR, exist_ok=True)
+    base = os.path.join(SCENE_CACHE_DIR, key)
+    tmp = '.tmp%d' % os.getpid()
+
+    f = open(base + '.bin' + tmp, 'wb')
+    for raw in blob:
+        f.write(raw)
+    f.close()
+
+    f = open(base + '.json' + tmp, 'w')
+    f.write(json.dumps(index, separators=(',', ':')))  # dumps uses the C encoder, dump does not
+    f.close()
+
+    os.replace(base + '.bin' + tmp, base + '.bin')
+    os.replace(base + '.json' + tmp, base + '.json')
+
+    sceneCacheEvict()
+    return True
+
+
+def sceneCacheLoad(path):
+    """
+    Return the root node of path from the cache, or None.
+    Arrays are read-only views of the memory mapped binary file.
+    """
+    if not SCENE_CACHE_DIR:
+        return None
+
+    key = sceneCacheKey(path)
+    if key is None:
+        return None
+
+    base = os.path.join(SCENE_CACHE_DIR, key)
+    try:
+        f = open(base + '.json', 'r')
+        index = json.load(f)
+        f.close()
+
+        f = open(base + '.bin', 'rb')
+        if os.fstat(f.fileno()).st_size:
+            blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            blob = b''  # can't map an empty file
+        f.close()
+
+        # Most recently used, see sceneCacheEvict()
+        os.utime(base + '.json')
+        os.utime(base + '.bin')
+    except (OSError, ValueError):
+        return None
+
+    def load(ref):
+        if type(ref) != dict:
+            return ref
+        if 'text' in ref:
+            return blob[ref['text']:ref['text'] + ref['count']].decode('utf-8')
+        return np.frombuffer(blob, dtype=np.dtype(ref['dtype']), count=ref['count'], offset=ref['offset'])
+
+    records = index['nodes']
+    nodes = []
+    for record in records:
+        if 'tag' in record:
+            blob_attributes = {name: (blob, ref['text'], ref['count'])
+                               for name, ref in record.get('blob_attributes', {}).items()}
+            node = x3dNode(None, record['node_type'], x3dElement(record['tag'], record['attributes'], blob_attributes))
+        else:
+            node = vrmlNode(None, record['node_type'], record['lineno'])
+        nodes.append(node)
+
+    for node, record in zip(nodes, records):
+        if 'parent' in record:
+            node.parent = nodes[record['parent']]
+        if 'id' in record:
+            node.id = tuple(record['id'])
+        if 'reference' in record:
+            node.reference = nodes[record['reference']]
+        if 'proto_node' in record:
+            node.proto_node = nodes[record['proto_node']]
+        if 'array_cache' in record:
+            node.array_cache = {field: load(value) for field, value in record['array_cache'].items()}
+
+        if 'children' in record:
+            node.children = [nodes[i] for i in record['children']]
+            node.fields = tuple(vrmlField(f) for f in record['fields'])
+            node.proto_field_defs = tuple(vrmlField(f) for f in record['proto_field_defs'])
+            node.array_data = load(record['array_data'])
+
+    # Once all the ids are known
+    for node in nodes:
+        if not node.x3dNode and node.node_type != NODE_REFERENCE:
+            node.field_index = node.indexFields()
+
+    root = nodes[index['root']]
+    root.setRoot(path)
+    root.DEF_NAMESPACE.update({key: nodes[i] for key, i in index['DEF'].items()})
+    root.PROTO_NAMESPACE.update({key: nodes[i] for key, i in index['PROTO'].items()})
+
+    return root
+
+
+def sceneCacheEvict():
+    """
+    Remove the least recently used scenes until the cache fits in SCENE_CACHE_SIZE.
+    """
+    entries = []
+    total = 0
+    for name in os.listdir(SCENE_CACHE_DIR):
+        if not name.endswith('.json'):
+            continue
+
+        base = os.path.join(SCENE_CACHE_DIR, name[:-5])
+        try:
+            size = os.path.getsize(base + '.json') + os.path.getsize(base + '.bin')
+            used = os.path.getmtime(base + '.json')
+        except OSError:
+            continue
+
+        entries.append((used, size, base))
+        total += size
+
+    entries.sort()
+    for used, size, base in entries:
+        if total <= SCENE_CACHE_SIZE:
+            break
+
+        for ext in ('.json', '.bin'):
+            try:
+                os.remove(base + ext)
+            except OSError:
+                pass
+        total -= size
+
+# ====================== Texture cache
+
+def textureCacheGet(key, ext):
+    """
+    Path of the image kept under key, None when there is none.
+    """
+    if not TEXTURE_CACHE_DIR:
+        return None
+
+    path = os.path.join(TEXTURE_CACHE_DIR, key + ext)
+    try:
+        os.utime(path)  # Most recently used, see textureCacheEvict()
+    except OSError:
         return None
+    return path
 
 
-def gzipOpen(path):
-    import gzip
+def textureCacheStore(key, ext, write):
+    """
+    Keep the image that write(path) writes under key, returns its path
+    or None when the cache is off or writing failed.
+    """
+    if not TEXTURE_CACHE_DIR:
+        return None
 
-    data = None
+    # Write under a temporary name first, so an other Blender never reads half a file.
+    # The extension stays last, converters pick the format from it.
+    os.makedirs(TEXTURE_CACHE_DIR, exist_ok=True)
+    path = os.path.join(TEXTURE_CACHE_DIR, key + ext)
+    tmp = os.path.join(TEXTURE_CACHE_DIR, '%s.tmp%d%s' % (key, os.getpid(), ext))
     try:
-        data = gzip.open(path, 'r').read()
-    except:
-        pass
-
-    if data is None:
+        write(tmp)
+        os.replace(tmp, path)
+    except (OSError, ValueError):
         try:
-            filehandle = open(path, 'rU')
-            data = filehandle.read()
-            filehandle.close()
-        except:
+            os.remove(tmp)
+        except OSError:
             pass
-    else:
-        data = data.decode('utf-8', "replace")
+        return None
 
-    return data
+    textureCacheEvict()
+    return path
 
 
-def vrml_parse(path):
+def textureCacheEvict():
     """
-    Sets up the root node and returns it so load_web3d() can deal with the blender side of things.
-    Return root (vrmlNode, '') or (None, 'Error String')
+    Remove the least recently used images until the cache fits in TEXTURE_CACHE_SIZE.
     """
-    data = gzipOpen(path)
+    entries = []
+    total = 0
+    for name in os.listdir(TEXTURE_CACHE_DIR):
+        if '.tmp' in name:
+            continue
 
-    if data is None:
-        return None, 'Failed to open file: ' + path
+        path = os.path.join(TEXTURE_CACHE_DIR, name)
+        try:
+            size = os.path.getsize(path)
+            used = os.path.getmtime(path)
+        except OSError:
+            continue
 
-    # Stripped above
-    lines[:] = vrmlFormat(data)
+        entries.append((used, size, path))
+        total += size
 
-    lines.insert(0, '{')
-    lines.insert(0, 'dymmy_node')
-    lines.append('}')
-    # Use for testing our parsed output, so we can check on line numbers.
+    entries.sort()
+    for used, size, path in entries:
+        if total <= TEXTURE_CACHE_SIZE:
+            break
 
-    '''
-    ff = open('/tmp/test.txt', 'w')
-    ff.writelines([l+'\n' for l in lines])
-    ff.close()
-    '''
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
 
-    # Now evaluate it
-    node_type, new_i = is_nodeline(0, [])
-    if not node_type:
-        return None, 'Error: VRML file has no starting Node'
 
-    # Trick to make sure we get all root nodes.
-    lines.insert(0, '{')
-    lines.insert(0, 'root_node____')  # important the name starts with an ascii char
-    lines.append('}')
+def ifsFaceLoops(index, ccw):
+    """
+    Splits an IndexedFaceSet coordIndex (trailing -1s stripped) into faces.
+    Returns (gather, loop_face, face_lengths): a function picking the value
+    of every corner (loop) out of an array laid out like coordIndex, the
+    face number of every corner, and the length of every non empty face.
+    gather returns None for an array shorter than coordIndex.
+    """
+    # Faces are separated by -1, find where each starts and stops
+    face_ends = np.flatnonzero(index == -1)
+    face_starts = np.concatenate(([0], face_ends + 1))
+    face_stops = np.concatenate((face_ends, [len(index)]))
+    face_lengths = face_stops - face_starts
+
+    # The position in coordIndex of every corner, face by face
+    loop_pos = np.flatnonzero(index != -1)
+    loop_face = np.repeat(np.arange(len(face_lengths)), face_lengths)
+    if not ccw:
+        # Reverse the winding of all faces at once
+        loop_pos = (face_starts + face_stops - 1)[loop_face] - loop_pos
 
-    root = vrmlNode(None, NODE_NORMAL, -1)
-    root.setRoot(path)  # we need to set the root so we have a namespace and know the path in case of inlineing
+    def gather(values):
+        if len(values) < len(index):
+            return None
+        return values[loop_pos]
+    # Empty faces (-1 -1) count for per face values but don't make polygons
+    return gather, loop_face, face_lengths[face_lengths > 0]
 
-    # Parse recursively
-    root.parse(0)
 
-    # This prints a load of text
-    if DEBUG:
-        print(root)
+def weldVertices(points, distance):
+    """
+    Merges the vertices that round to the same point of a grid with the given
+    spacing, what remove_doubles would do to them, without leaving object mode.
+    Returns (keep, remap): the vertices to keep, in their original order,
+    and the new index of every vertex.
+    """
+    cells = np.floor(points / np.float64(distance) + 0.5)
+    if not len(cells) or not (np.abs(cells).max() < 2.0 ** 62):
+        # Nothing to weld, or a distance too small for the grid to hold
+        everything = np.arange(len(points))
+        return everything, everything
+    cells = cells.astype(np.int64)
+
+    # One key per row, so unique works on older numpy (no axis argument)
+    cells -= cells.min(axis=0)
+    span = cells.max(axis=0) + 1
+    if float(span[0]) * float(span[1]) * float(span[2]) < 2.0 ** 62:
+        rows = (cells[:, 0] * span[1] + cells[:, 1]) * span[2] + cells[:, 2]
+    else:
+        rows = cells.view(np.dtype((np.void, cells.dtype.itemsize * 3))).ravel()
+    _, keep, remap = np.unique(rows, return_index=True, return_inverse=True)
 
-    return root, ''
+    order = np.argsort(keep)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    return keep[order], rank[remap]
 
 
-# ====================== END VRML
+def primitiveKey(geom, ancestry):
+    """
+    What makes the mesh of a Sphere, Cylinder, Cone or Box other than its
+    size, primitives with the same key can share one unit sized mesh.
+    """
+    return (geom.getSpec(),
+            tuple(geom.getFieldAsArray('subdivision', 0, ancestry)),
+            geom.getFieldAsBool('bottom', True, ancestry),
+            geom.getFieldAsBool('side', True, ancestry),
+            geom.getFieldAsBool('top', True, ancestry))
 
-# ====================== X3d Support
 
-# Sane as vrml but replace the parser
-class x3dNode(vrmlNode):
-    def __init__(self, parent, node_type, x3dNode):
-        vrmlNode.__init__(self, parent, node_type, -1)
-        self.x3dNode = x3dNode
+def primitiveSize(geom, ancestry):
+    """
+    The scale that takes the unit sized mesh of a primitive to its real size.
+    """
+    spec = geom.getSpec()
+    if spec == 'Sphere':
+        r = geom.getFieldAsFloat('radius', 0.5, ancestry)
+        return (r, r, r)
+    elif spec == 'Cylinder':
+        r = geom.getFieldAsFloat('radius', 1.0, ancestry)
+        return (r, geom.getFieldAsFloat('height', 2, ancestry) / 2, r)
+    elif spec == 'Cone':
+        r = geom.getFieldAsFloat('bottomRadius', 1.0, ancestry)
+        return (r, geom.getFieldAsFloat('height', 2, ancestry) / 2, r)
+    else:  # Box
+        (dx, dy, dz) = geom.getFieldAsFloatTuple('size', (2.0, 2.0, 2.0), ancestry)
+        return (dx / 2, dy / 2, dz / 2)
+
+
+def materialKey(material, ancestry):
+    """
+    The values appearance_CreateMaterial reads, the same for VRML and X3D.
+    Materials with equal keys make the same Blender material, however
+    they were written (Chimera repeats one for every shape).
+    """
+    return ('Material',
+            material.getFieldAsFloat('ambientIntensity', 0.2, ancestry),
+            tuple(material.getFieldAsFloatTuple('diffuseColor', [0.8, 0.8, 0.8], ancestry)),
+            tuple(material.getFieldAsFloatTuple('emissiveColor', [0.0, 0.0, 0.0], ancestry)),
+            material.getFieldAsFloat('shininess', 0.2, ancestry),
+            tuple(material.getFieldAsFloatTuple('specularColor', [0.0, 0.0, 0.0], ancestry)),
+            material.getFieldAsFloat('transparency', 0.0, ancestry))
 
-    def parse(self, IS_PROTO_DATA=False):
-        # print(self.x3dNode.tagName)
 
-        define = self.x3dNode.getAttributeNode('DEF')
-        if define:
-            self.getDefDict()[define.value] = self
-        else:
-            use = self.x3dNode.getAttributeNode('USE')
-            if use:
-                try:
-                    self.reference = self.getDefDict()[use.value]
-                    self.node_type = NODE_REFERENCE
-                except:
-                    print('\tWarning: reference', use.value, 'not found')
-                    self.parent.children.remove(self)
+def imageTextureUrls(imageTexture, ancestry):
+    """
+    The urls of an ImageTexture as a list, None if it has none.
+    """
+    ima_urls = imageTexture.getFieldAsString('url', None, ancestry)
 
-                return
+    if ima_urls is None:
+        try:
+            ima_urls = imageTexture.getFieldAsStringArray('url', ancestry)
+            # in some cases we get a list of images.
+        except:
+            ima_urls = None
+    else:
+        if '" "' in ima_urls:
+            # '"foo" "bar"' --> ['foo', 'bar']
+            ima_urls = [w.strip('"') for w in ima_urls.split('" "')]
+        else:
+            ima_urls = [ima_urls]
+    return ima_urls
 
-        for x3dChildNode in self.x3dNode.childNodes:
-            if x3dChildNode.nodeType in {x3dChildNode.TEXT_NODE, x3dChildNode.COMMENT_NODE, x3dChildNode.CDATA_SECTION_NODE}:
-                continue
 
-            node_type = NODE_NORMAL
-            # print(x3dChildNode, dir(x3dChildNode))
-            if x3dChildNode.getAttributeNode('USE'):
-                node_type = NODE_REFERENCE
+def pixelTextureDigest(tex_node, ancestry):
+    """
+    Hash of the pixels of a PixelTexture. A DEF'd one keeps it next to its
+    buffers, so every USE of it doesn't hash the pixels again.
+    """
+    array_data = tex_node.getFieldArrayData('image', ancestry)
+    tex_real = tex_node.getRealNode()
+    key = ('image', 'sha1')
+    if tex_real.buffer_cache is not None and key in tex_real.buffer_cache:
+        source, digest = tex_real.buffer_cache[key]
+        if source is array_data:
+            return digest
+
+    if type(array_data) == np.ndarray:
+        digest = hashlib.sha1(array_data.tobytes()).hexdigest()
+    else:  # eg: hex values, left as they were written
+        digest = hashlib.sha1(repr(array_data).encode('utf-8')).hexdigest()
+
+    if tex_real.canHaveReferences():
+        if tex_real.buffer_cache is None:
+            tex_real.buffer_cache = {}
+        tex_real.buffer_cache[key] = (array_data, digest)
+    return digest
+
+
+def pixelTextureImage(tex_node, ancestry):
+    """
+    Width, height, plane count and the packed pixels of a PixelTexture,
+    the pixels as a numpy array. Hex values (0xFF00FF), which the number
+    decoder leaves as text, are converted here. None if it can't be read.
+    """
+    image = tex_node.getFieldArrayData('image', ancestry)
+    if type(image) != np.ndarray:
+        values = []
+        try:
+            for val in groupArray(image, 0):
+                if type(val) != str:
+                    values.append(int(val))
+                    continue
+                for word in val.replace(',', ' ').split():
+                    values.append(int(word, 16) if word[:2].lower() == '0x' else int(word))
+        except ValueError:
+            print('\tWarning, PixelTexture image could not be read')
+            return None
+        image = np.array(values, dtype=np.int64)
 
-            child = x3dNode(self, node_type, x3dChildNode)
-            child.parse()
+    if len(image) < 3:
+        return None
 
-        # TODO - x3d Inline
+    w, h, plane_count = (int(v) for v in image[0:3])
+    return w, h, plane_count, image[3:]
 
-    def getSpec(self):
-        return self.x3dNode.tagName  # should match vrml spec
 
-    def getDefName(self):
-        data = self.x3dNode.getAttributeNode('DEF')
-        if data:
-            data.value  # XXX, return??
+def pixelTextureRGBA(pixels, plane_count):
+    """
+    Unpack PixelTexture pixels to flat RGBA floats from 0 to 1, the layout
+    of Blender's Image.pixels. None for a plane count other than 1 to 4.
+    """
+    # Shift of each channel in the packed value, None for an opaque alpha
+    shifts = {1: (0, 0, 0, None),  # Intensity - does Blender even support that?
+              2: (8, 8, 8, 0),  # Intensity/alpha
+              3: (16, 8, 0, None),  # RGB
+              4: (24, 16, 8, 0),  # RGBA
+              }.get(plane_count)
+    if shifts is None:
         return None
 
-    # Other funcs operate from vrml, but this means we can wrap XML fields, still use nice utility funcs
-    # getFieldAsArray getFieldAsBool etc
-    def getFieldName(self, field, ancestry, AS_CHILD=False, SPLIT_COMMAS=False):
-        # ancestry and AS_CHILD are ignored, only used for VRML now
-
-        self_real = self.getRealNode()  # in case we're an instance
-        field_xml = self.x3dNode.getAttributeNode(field)
-        if field_xml:
-            value = field_xml.value
-
-            # We may want to edit. for x3d specific stuff
-            # Sucks a bit to return the field name in the list but vrml excepts this :/
-            if SPLIT_COMMAS:
-                value = value.replace(",", " ")
-            return value.split()
+    packed = pixels.astype(np.uint32, copy=False)
+    rgba = np.empty((len(packed), 4), dtype=np.float32)
+    for channel, shift in enumerate(shifts):
+        if shift is None:
+            rgba[:, channel] = 255
         else:
-            return None
-
-    def canHaveReferences(self):
-        return self.x3dNode.getAttributeNode('DEF')
-
-    def desc(self):
-        return self.getRealNode().x3dNode.toxml()
+            rgba[:, channel] = (packed >> np.uint32(shift)) & np.uint32(0xff)
+    rgba /= 255
+    return rgba.reshape(-1)
 
 
-def x3d_parse(path):
+def textureKey(tex_node, ancestry, node):
     """
-    Sets up the root node and returns it so load_web3d() can deal with the blender side of things.
-    Return root (x3dNode, '') or (None, 'Error String')
+    What makes the image of an ImageTexture or PixelTexture, None when it
+    has no image to load. Urls are relative to the file of the shape (node),
+    so the same url in another file of a multi-file model is another image.
+    Pixels are hashed, they can be megabytes.
     """
+    if tex_node.getSpec() == 'ImageTexture':
+        ima_urls = imageTextureUrls(tex_node, ancestry)
+        if not ima_urls:
+            return None
+        image = (tuple(ima_urls), os.path.dirname(node.getFilename()))
+    else:  # PixelTexture
+        image = pixelTextureDigest(tex_node, ancestry)
 
-    try:
-        import xml.dom.minidom
-    except:
-        return None, 'Error, import XML parsing module (xml.dom.minidom) failed, install python'
-
-    '''
-    try:    doc = xml.dom.minidom.parse(path)
-    except: return None, 'Could not parse this X3D file, XML error'
-    '''
-
-    # Could add a try/except here, but a console error is more useful.
-    data = gzipOpen(path)
-
-    if data is None:
-        return None, 'Failed to open file: ' + path
-
-    doc = xml.dom.minidom.parseString(data)
-
-    try:
-        x3dnode = doc.getElementsByTagName('X3D')[0]
-    except:
-        return None, 'Not a valid x3d document, cannot import'
-
-    bpy.ops.object.select_all(action='DESELECT')
+    return (tex_node.getSpec(), image,
+            tex_node.getFieldAsBool('repeatS', True, ancestry),
+            tex_node.getFieldAsBool('repeatT', True, ancestry))
 
-    root = x3dNode(None, NODE_NORMAL, x3dnode)
-    root.setRoot(path)  # so images and Inline's we load have a relative path
-    root.parse()
 
-    return root, ''
+def parentMap(all_nodes):
+    """
+    {parent object: [child objects]} for the nodes with a blendObject, the
+    parent being the blendObject of the nearest ancestor that has one.
+    """
+    child_dict = {}
+    for node, ancestry in all_nodes:
+        child = node.blendObject
+        if not child:
+            continue
+        # Get the last parent
+        for parent_node in reversed(ancestry):
+            if parent_node.blendObject:
+                child_dict.setdefault(parent_node.blendObject, []).append(child)
+                break
+    return child_dict
 
 ## f = open('/_Cylinder.wrl', 'r')
 # f = open('/fe/wrl/Vrml/EGS/TOUCHSN.WRL', 'r')
@@ -1431,11 +2594,15 @@ for i, f in enumerate(files):
 
 # NO BLENDER CODE ABOVE THIS LINE.
 # -----------------------------------------------------------------------------------
-import bpy
-from bpy_extras import image_utils
-from mathutils import Vector, Matrix, Quaternion
+try:
+    import bpy
+    from bpy_extras import image_utils
+    from mathutils import Vector, Matrix, Quaternion
+except ImportError:
+    # Only the parser is usable, eg: from bench_import_x3d.py
+    bpy = None
 
-GLOBALS = {'CIRCLE_DETAIL': 16}
+GLOBALS = {'CIRCLE_DETAIL': 16, 'MERGE_DISTANCE': 0.0, 'CACHE': False}
 
 
 def translateRotation(rot):
@@ -1534,24 +2701,37 @@ def translateTexTransform(node, ancestry):
 
     return new_mat
 
-def getFinalMatrix(node, mtx, ancestry, global_matrix):
+def getTransformMatrix(ancestry):
+    """
+    The product of the Transforms in ancestry, outermost first.
+    Kept in transform_cache for every ancestry prefix, so a Transform is
+    translated once however many nodes are under it. The same node can be
+    under different ancestries (DEF/USE, PROTO instances), so the cache is
+    by ancestry rather than by node.
+    """
+    mtx = transform_cache.get(ancestry)
+    if mtx is None:
+        if ancestry:
+            mtx = getTransformMatrix(ancestry[:-1])
+            if ancestry[-1].getSpec() == 'Transform':
+                mtx = mtx * translateTransform(ancestry[-1], ancestry[:-1])
+        else:
+            mtx = Matrix()
+        transform_cache[ancestry] = mtx
+    return mtx
 
-    transform_nodes = [node_tx for node_tx in ancestry if node_tx.getSpec() == 'Transform']
-    if node.getSpec() == 'Transform':
-        transform_nodes.append(node)
-    transform_nodes.reverse()
 
-    if mtx is None:
-        mtx = Matrix()
+def getFinalMatrix(node, mtx, ancestry, global_matrix):
+    ancestry = tuple(ancestry)
+    if node.getSpec() == 'Transform':
+        ancestry += (node,)
 
-    for node_tx in transform_nodes:
-        mat = translateTransform(node_tx, ancestry)
-        mtx = mat * mtx
+    world = getTransformMatrix(ancestry)
+    if mtx is not None:
+        world = world * mtx
 
     # worldspace matrix
-    mtx = global_matrix * mtx
-
-    return mtx
+    return global_matrix * world
 
 
 # -----------------------------------------------------------------------------------
@@ -1564,25 +2744,25 @@ def getFinalMatrix(node, mtx, ancestry, global_matrix):
 # for nonindexed ones, this is a consideration.
 
 
+def importMesh_TessfaceVertices(bpymesh):
+    # The vertex indices of all tessfaces, in rows of 4
+    faces = np.zeros(len(bpymesh.tessfaces) * 4, dtype=np.int32)
+    bpymesh.tessfaces.foreach_get("vertices_raw", faces)
+    return faces.reshape(-1, 4)
+
+
 def importMesh_ApplyColors(bpymesh, geom, ancestry):
     colors = geom.getChildBySpec(['ColorRGBA', 'Color'])
     if colors:
         if colors.getSpec() == 'ColorRGBA':
-            # Array of arrays; no need to flatten
-            rgb = [c[:3] for c
-                   in colors.getFieldAsArray('color', 4, ancestry)]
+            rgb = colors.getFieldAsBuffer('color', 4, ancestry, np.float32)[:, :3]
         else:
-            rgb = colors.getFieldAsArray('color', 3, ancestry)
+            rgb = colors.getFieldAsBuffer('color', 3, ancestry, np.float32)
+        faces = importMesh_TessfaceVertices(bpymesh)
         tc = bpymesh.tessface_vertex_colors.new()
-        tc.data.foreach_set("color1", [i for face
-                                       in bpymesh.tessfaces
-                                       for i in rgb[face.vertices[0]]])
-        tc.data.foreach_set("color2", [i for face
-                                       in bpymesh.tessfaces
-                                       for i in rgb[face.vertices[1]]])
-        tc.data.foreach_set("color3", [i for face
-                                       in bpymesh.tessfaces
-                                       for i in rgb[face.vertices[2]]])
+        tc.data.foreach_set("color1", rgb[faces[:, 0]].ravel())
+        tc.data.foreach_set("color2", rgb[faces[:, 1]].ravel())
+        tc.data.foreach_set("color3", rgb[faces[:, 2]].ravel())
 
 
 # Assumes that the vertices have not been rearranged compared to the
@@ -1595,7 +2775,7 @@ def importMesh_ApplyNormals(bpymesh, geom, ancestry):
         return
 
     per_vertex = geom.getFieldAsBool('normalPerVertex', True, ancestry)
-    vectors = normals.getFieldAsArray('vector', 0, ancestry)
+    vectors = normals.getFieldAsBuffer('vector', 0, ancestry, np.float32)
     if per_vertex:
         bpymesh.vertices.foreach_set("normal", vectors)
     else:
@@ -1611,11 +2791,9 @@ def importMesh_ApplyNormals(bpymesh, geom, ancestry):
 # Vertex culling that we have in IndexedFaceSet is an unfortunate exception,
 # brought forth by a very specific issue.
 def importMesh_ReadVertices(bpymesh, geom, ancestry):
-    # We want points here as a flat array, but the caching logic in
-    # IndexedFaceSet presumes a 2D one.
-    # The case for caching is stronger over there.
+    # A flat view of the same buffer IndexedFaceSet reads as rows
     coord = geom.getChildBySpec('Coordinate')
-    points = coord.getFieldAsArray('point', 0, ancestry)
+    points = coord.getFieldAsBuffer('point', 0, ancestry, np.float32)
     bpymesh.vertices.add(len(points) // 3)
     bpymesh.vertices.foreach_set("co", points)
 
@@ -1635,16 +2813,15 @@ def importMesh_ApplyTextureToTessfaces(bpymesh, geom, ancestry, bpyima):
     if not tex_coord:
         return
 
-    coord_points = tex_coord.getFieldAsArray('point', 2, ancestry)
-    if not coord_points:
+    coord_points = tex_coord.getFieldAsBuffer('point', 2, ancestry, np.float32)
+    if not len(coord_points):
         return
 
     d = bpymesh.tessface_uv_textures.new().data
     for face in d:  # No foreach_set for nonscalars
         face.image = bpyima
-    uv = [i for face in bpymesh.tessfaces
-          for vno in range(3) for i in coord_points[face.vertices[vno]]]
-    d.foreach_set('uv', uv)
+    faces = importMesh_TessfaceVertices(bpymesh)
+    d.foreach_set('uv', coord_points[faces[:, :3]].ravel())
 
 
 # Common steps for all triangle meshes once the geometry has been set:
@@ -1684,12 +2861,11 @@ def importMesh_IndexedTriangleSet(geom, ancestry, bpyima):
     importMesh_ReadVertices(bpymesh, geom, ancestry)
 
     # Read the faces
-    index = geom.getFieldAsArray('index', 0, ancestry)
-    n = len(index) // 3
+    index = geom.getFieldAsBuffer('index', 3, ancestry, np.int32)
     if not ccw:
-        index = [index[3 * i + j] for i in range(n) for j in (1, 0, 2)]
-    bpymesh.tessfaces.add(n)
-    bpymesh.tessfaces.foreach_set("vertices", index)
+        index = index[:, (1, 0, 2)]
+    bpymesh.tessfaces.add(len(index))
+    bpymesh.tessfaces.foreach_set("vertices", index.ravel())
 
     return importMesh_FinalizeTriangleMesh(bpymesh, geom, ancestry, bpyima)
 
@@ -1826,162 +3002,117 @@ def importMesh_IndexedFaceSet(geom, ancestry, bpyima):
     # In Blender, to the best of my knowledge, there's no way to reuse
     # the vertex set between meshes. So we have culling logic instead -
     # for each mesh, only leave vertices that are used for faces.
+    #
+    # Everything is done on numpy arrays, Chimera surfaces have millions of indices.
 
     ccw = geom.getFieldAsBool('ccw', True, ancestry)
     coord = geom.getChildBySpec('Coordinate')
-    if coord.reference:
-        points = coord.getRealNode().parsed
-        # We need unflattened coord array here, while
-        # importMesh_ReadVertices uses flattened. Can't cache both :(
-        # TODO: resolve that somehow, so that vertex set can be effectively
-        # reused between different mesh types?
-    else:
-        points = coord.getFieldAsArray('point', 3, ancestry)
-        if coord.canHaveReferences():
-            coord.parsed = points
-    index = geom.getFieldAsArray('coordIndex', 0, ancestry)
+    points = coord.getFieldAsBuffer('point', 3, ancestry, np.float32)
+    index = geom.getFieldAsBuffer('coordIndex', 0, ancestry, np.int32)
 
-    while index[-1] == -1:
-        del index[-1]
+    end = len(index)
+    while end and index[end - 1] == -1:
+        end -= 1
+    index = index[:end]
+
+    gather, loop_face, face_lengths = ifsFaceLoops(index, ccw)
+    verts = gather(index)
 
     if len(points) >= 2 * len(index):  # Need to cull
-        culled_points = []
-        cull = {}  # Maps old vertex indices to new ones
-        uncull = []  # Maps new indices to the old ones
-        new_index = 0
+        uncull, loop_verts = np.unique(verts, return_inverse=True)  # uncull maps new indices to the old ones
+        points = points[uncull]
     else:
-        uncull = cull = None
+        loop_verts = verts
 
-    faces = []
-    face = []
-    # Generate faces. Cull the vertices if necessary,
-    for i in index:
-        if i == -1:
-            faces.append(flip(face, ccw))
-            face = []
-        else:
-            if cull is not None:
-                if not(i in cull):
-                    culled_points.append(points[i])
-                    cull[i] = new_index
-                    uncull.append(i)
-                    i = new_index
-                    new_index += 1
-                else:
-                    i = cull[i]
-            face.append(i)
-    faces.append(flip(face, ccw))  # The last face
+    if GLOBALS['MERGE_DISTANCE'] > 0.0:
+        # Weld coincident vertices, normals and colors follow the loops
+        keep, remap = weldVertices(points, GLOBALS['MERGE_DISTANCE'])
+        points = points[keep]
+        loop_verts = remap[loop_verts]
 
-    if cull:
-        points = culled_points
+    loop_starts = np.cumsum(face_lengths) - face_lengths
 
     bpymesh = bpy.data.meshes.new(name="IndexedFaceSet")
-    bpymesh.from_pydata(points, [], faces)
+    bpymesh.vertices.add(len(points))
+    bpymesh.vertices.foreach_set("co", np.ascontiguousarray(points).ravel())
+    bpymesh.loops.add(len(loop_verts))
+    bpymesh.loops.foreach_set("vertex_index", loop_verts.astype(np.int32))
+    bpymesh.polygons.add(len(face_lengths))
+    bpymesh.polygons.foreach_set("loop_start", loop_starts.astype(np.int32))
+    bpymesh.polygons.foreach_set("loop_total", face_lengths.astype(np.int32))
+    bpymesh.update(calc_edges=True)
     # No validation here. It throws off the per-face stuff.
 
     # Similar treatment for normal and color indices
 
     def processPerVertexIndex(ind):
-        if ind:
-            # Deflatten into an array of arrays by face; the latter might
-            # need to be flipped
-            i = 0
-            verts_by_face = []
-            for f in faces:
-                verts_by_face.append(flip(ind[i:i + len(f)], ccw))
-                i += len(f) + 1
-            return verts_by_face
-        elif uncull:
-            return [[uncull[v] for v in f] for f in faces]
-        else:
-            return faces  # Reuse coordIndex, as per the spec
+        # The index for every loop
+        if len(ind):
+            # Laid out like coordIndex, the same positions apply
+            loops = gather(ind)
+            if loops is not None:
+                return loops
+            print('\tWarning, an index of an IndexedFaceSet is shorter than its coordIndex, it is ignored')
+        return verts  # Reuse coordIndex, as per the spec
+
+    # Original face numbers of the polygons, empty faces are skipped
+    poly_face = loop_face[loop_starts]
 
     # Normals
     normals = geom.getChildBySpec('Normal')
     if normals:
         per_vertex = geom.getFieldAsBool('normalPerVertex', True, ancestry)
-        vectors = normals.getFieldAsArray('vector', 3, ancestry)
-        normal_index = geom.getFieldAsArray('normalIndex', 0, ancestry)
+        vectors = normals.getFieldAsBuffer('vector', 3, ancestry, np.float32)
+        normal_index = geom.getFieldAsBuffer('normalIndex', 0, ancestry, np.int32)
         if per_vertex:
-            co = [co for f in processPerVertexIndex(normal_index)
-                  for v in f for co in vectors[v]]
-            bpymesh.vertices.foreach_set("normal", co)
+            # Blender has one normal per vertex, the last loop using a vertex wins
+            co = np.zeros((len(points), 3), dtype=np.float32)
+            co[loop_verts] = vectors[processPerVertexIndex(normal_index)]
+            bpymesh.vertices.foreach_set("normal", co.ravel())
         else:
-            co = [co for (i, f) in enumerate(faces) for j in f
-                  for co in vectors[normal_index[i] if normal_index else i]]
-            bpymesh.polygons.foreach_set("normal", co)
+            co = vectors[normal_index[poly_face] if len(normal_index) else poly_face]
+            bpymesh.polygons.foreach_set("normal", co.ravel())
 
     # Apply vertex/face colors
     colors = geom.getChildBySpec(['ColorRGBA', 'Color'])
     if colors:
         if colors.getSpec() == 'ColorRGBA':
-            # Array of arrays; no need to flatten
-            rgb = [c[:3] for c
-                   in colors.getFieldAsArray('color', 4, ancestry)]
+            rgb = colors.getFieldAsBuffer('color', 4, ancestry, np.float32)[:, :3]
         else:
-            rgb = colors.getFieldAsArray('color', 3, ancestry)
+            rgb = colors.getFieldAsBuffer('color', 3, ancestry, np.float32)
 
         color_per_vertex = geom.getFieldAsBool('colorPerVertex',
                                                True, ancestry)
-        color_index = geom.getFieldAsArray('colorIndex', 0, ancestry)
+        color_index = geom.getFieldAsBuffer('colorIndex', 0, ancestry, np.int32)
 
         d = bpymesh.vertex_colors.new().data
         if color_per_vertex:
-            cco = [cco for f in processPerVertexIndex(color_index)
-                   for v in f for cco in rgb[v]]
-        elif color_index:  # Color per face with index
-            cco = [cco for (i, f) in enumerate(faces) for j in f
-                   for cco in rgb[color_index[i]]]
+            cco = rgb[processPerVertexIndex(color_index)]
+        elif len(color_index):  # Color per face with index
+            cco = rgb[color_index[loop_face]]
         else:  # Color per face without index
-            cco = [cco for (i, f) in enumerate(faces) for j in f
-                   for cco in rgb[i]]
-        d.foreach_set('color', cco)
+            cco = rgb[loop_face]
+        d.foreach_set('color', cco.ravel())
 
     # Texture
     if bpyima:
         tex_coord = geom.getChildBySpec('TextureCoordinate')
         if tex_coord:
-            tex_coord_points = tex_coord.getFieldAsArray('point', 2, ancestry)
-            tex_index = geom.getFieldAsArray('texCoordIndex', 0, ancestry)
-            tex_index = processPerVertexIndex(tex_index)
-            loops = [co for f in tex_index
-                     for v in f for co in tex_coord_points[v]]
+            tex_coord_points = tex_coord.getFieldAsBuffer('point', 2, ancestry, np.float32)
+            tex_index = geom.getFieldAsBuffer('texCoordIndex', 0, ancestry, np.int32)
+            loops = tex_coord_points[processPerVertexIndex(tex_index)]
         else:
-            x_min = x_max = y_min = y_max = z_min = z_max = None
-            for f in faces:
-                # Unused vertices don't participate in size; X3DOM does so
-                for v in f:
-                    (x, y, z) = points[v]
-                    if x_min is None or x < x_min:
-                        x_min = x
-                    if x_max is None or x > x_max:
-                        x_max = x
-                    if y_min is None or y < y_min:
-                        y_min = y
-                    if y_max is None or y > y_max:
-                        y_max = y
-                    if z_min is None or z < z_min:
-                        z_min = z
-                    if z_max is None or z > z_max:
-                        z_max = z
-
-            mins = (x_min, y_min, z_min)
-            deltas = (x_max - x_min, y_max - y_min, z_max - z_min)
+            # Unused vertices don't participate in size; X3DOM does so
+            used_points = points[loop_verts]
+            mins = used_points.min(axis=0)
+            deltas = (used_points.max(axis=0) - mins).tolist()
             axes = [0, 1, 2]
             axes.sort(key=lambda a: (-deltas[a], a))
             # Tuple comparison breaks ties
-            (s_axis, t_axis) = axes[0:2]
-            s_min = mins[s_axis]
-            ds = deltas[s_axis]
-            t_min = mins[t_axis]
-            dt = deltas[t_axis]
-
-            def generatePointCoords(pt):
-                return (pt[s_axis] - s_min) / ds, (pt[t_axis] - t_min) / dt
-            loops = [co for f in faces for v in f
-                     for co in generatePointCoords(points[v])]
+            st_axes = axes[0:2]
+            loops = (used_points[:, st_axes] - mins[st_axes]) / np.array(deltas, dtype=np.float32)[st_axes]
 
-        importMesh_ApplyTextureToLoops(bpymesh, bpyima, loops)
+        importMesh_ApplyTextureToLoops(bpymesh, bpyima, loops.astype(np.float32).ravel())
 
     bpymesh.validate(False)
     bpymesh.update()
@@ -2294,7 +3425,7 @@ def importMesh_LineSet(geom, ancestry, bpyima):
     # TODO: line display properties are ignored
     # Per-vertex color is ignored
     coord = geom.getChildBySpec('Coordinate')
-    src_points = coord.getFieldAsArray('point', 3, ancestry)
+    src_points = coord.getFieldAsBuffer('point', 3, ancestry, np.float32)
     # Array of 3; Blender needs arrays of 4
     bpycurve = bpy.data.curves.new("LineSet", 'CURVE')
     bpycurve.dimensions = '3D'
@@ -2304,13 +3435,9 @@ def importMesh_LineSet(geom, ancestry, bpyima):
         sp = bpycurve.splines.new('POLY')
         sp.points.add(n - 1)  # points already has one element
 
-        def points():
-            for x in src_points[b:b + n]:
-                yield x[0]
-                yield x[1]
-                yield x[2]
-                yield 0
-        sp.points.foreach_set('co', [x for x in points()])
+        co = np.zeros((n, 4), dtype=np.float32)
+        co[:, :3] = src_points[b:b + n]
+        sp.points.foreach_set('co', co.ravel())
         b += n
     return bpycurve
 
@@ -2320,11 +3447,11 @@ def importMesh_IndexedLineSet(geom, ancestry, _):
     # coord = geom.getChildByName('coord') # 'Coordinate'
     coord = geom.getChildBySpec('Coordinate')  # works for x3d and vrml
     if coord:
-        points = coord.getFieldAsArray('point', 3, ancestry)
+        points = coord.getFieldAsBuffer('point', 3, ancestry, np.float32)
     else:
         points = []
 
-    if not points:
+    if not len(points):
         print('\tWarning: IndexedLineSet had no points')
         return None
 
@@ -2363,16 +3490,16 @@ def importMesh_PointSet(geom, ancestry, _):
     # VRML not x3d
     coord = geom.getChildBySpec('Coordinate')  # works for x3d and vrml
     if coord:
-        points = coord.getFieldAsArray('point', 3, ancestry)
+        points = coord.getFieldAsBuffer('point', 3, ancestry, np.float32)
     else:
-        points = []
+        points = np.zeros((0, 3), dtype=np.float32)
 
     # vcolor = geom.getChildByName('color')
     # blender dosnt have per vertex color
 
     bpymesh = bpy.data.meshes.new("PointSet")
     bpymesh.vertices.add(len(points))
-    bpymesh.vertices.foreach_set("co", [a for v in points for a in v])
+    bpymesh.vertices.foreach_set("co", points.ravel())
 
     # No need to validate
     bpymesh.update()
@@ -2389,11 +3516,13 @@ def importMesh_PointSet(geom, ancestry, _):
 GLOBALS['CIRCLE_DETAIL'] = 12
 
 
-def importMesh_Sphere(geom, ancestry, bpyima):
+# With unit=True, the primitives are made with a size of 1 (a radius or half
+# the height), for primitiveSize() to scale. See importShape_LoadPrimitive().
+def importMesh_Sphere(geom, ancestry, bpyima, unit=False):
     # solid is ignored.
     # Extra field 'subdivision="n m"' attribute, specifying how many
     # rings and segments to use (X3DOM).
-    r = geom.getFieldAsFloat('radius', 0.5, ancestry)
+    r = 1.0 if unit else geom.getFieldAsFloat('radius', 0.5, ancestry)
     subdiv = geom.getFieldAsArray('subdivision', 0, ancestry)
     if subdiv:
         if len(subdiv) == 1:
@@ -2473,12 +3602,12 @@ def importMesh_Sphere(geom, ancestry, bpyima):
     return bpymesh
 
 
-def importMesh_Cylinder(geom, ancestry, bpyima):
+def importMesh_Cylinder(geom, ancestry, bpyima, unit=False):
     # solid is ignored
     # no ccw in this element
     # Extra parameter subdivision="n" - how many faces to use
-    radius = geom.getFieldAsFloat('radius', 1.0, ancestry)
-    height = geom.getFieldAsFloat('height', 2, ancestry)
+    radius = 1.0 if unit else geom.getFieldAsFloat('radius', 1.0, ancestry)
+    height = 2.0 if unit else geom.getFieldAsFloat('height', 2, ancestry)
     bottom = geom.getFieldAsBool('bottom', True, ancestry)
     side = geom.getFieldAsBool('side', True, ancestry)
     top = geom.getFieldAsBool('top', True, ancestry)
@@ -2533,12 +3662,12 @@ def importMesh_Cylinder(geom, ancestry, bpyima):
     return bpymesh
 
 
-def importMesh_Cone(geom, ancestry, bpyima):
+def importMesh_Cone(geom, ancestry, bpyima, unit=False):
     # Solid ignored
     # Extra parameter subdivision="n" - how many faces to use
     n = geom.getFieldAsInt('subdivision', GLOBALS['CIRCLE_DETAIL'], ancestry)
-    radius = geom.getFieldAsFloat('bottomRadius', 1.0, ancestry)
-    height = geom.getFieldAsFloat('height', 2, ancestry)
+    radius = 1.0 if unit else geom.getFieldAsFloat('bottomRadius', 1.0, ancestry)
+    height = 2.0 if unit else geom.getFieldAsFloat('height', 2, ancestry)
     bottom = geom.getFieldAsBool('bottom', True, ancestry)
     side = geom.getFieldAsBool('side', True, ancestry)
 
@@ -2575,10 +3704,13 @@ def importMesh_Cone(geom, ancestry, bpyima):
     return bpymesh
 
 
-def importMesh_Box(geom, ancestry, bpyima):
+def importMesh_Box(geom, ancestry, bpyima, unit=False):
     # Solid is ignored
     # No ccw in this element
-    (dx, dy, dz) = geom.getFieldAsFloatTuple('size', (2.0, 2.0, 2.0), ancestry)
+    if unit:
+        (dx, dy, dz) = (2.0, 2.0, 2.0)
+    else:
+        (dx, dy, dz) = geom.getFieldAsFloatTuple('size', (2.0, 2.0, 2.0), ancestry)
     dx /= 2
     dy /= 2
     dz /= 2
@@ -2677,7 +3809,7 @@ def appearance_LoadImageTextureFile(ima_urls, node):
         bpyima = image_utils.load_image(f, dirname,
                                         place_holder=False,
                                         recursive=False,
-                                        convert_callback=imageConvertCompat)
+                                        convert_callback=lambda path: imageConvertCompat(path, GLOBALS['CACHE']))
         if bpyima:
             break
 
@@ -2685,21 +3817,7 @@ def appearance_LoadImageTextureFile(ima_urls, node):
 
 
 def appearance_LoadImageTexture(imageTexture, ancestry, node):
-    # TODO: cache loaded textures...
-    ima_urls = imageTexture.getFieldAsString('url', None, ancestry)
-
-    if ima_urls is None:
-        try:
-            ima_urls = imageTexture.getFieldAsStringArray('url', ancestry)
-            # in some cases we get a list of images.
-        except:
-            ima_urls = None
-    else:
-        if '" "' in ima_urls:
-            # '"foo" "bar"' --> ['foo', 'bar']
-            ima_urls = [w.strip('"') for w in ima_urls.split('" "')]
-        else:
-            ima_urls = [ima_urls]
+    ima_urls = imageTextureUrls(imageTexture, ancestry)
     # ima_urls is a list or None
 
     if ima_urls is None:
@@ -2719,17 +3837,15 @@ def appearance_LoadImageTexture(imageTexture, ancestry, node):
 
 
 def appearance_LoadTexture(tex_node, ancestry, node):
-    # Both USE-based caching and desc-based caching
+    # Both USE-based caching and textureKey-based caching
     # Works for bother ImageTextures and PixelTextures
 
     # USE-based caching
     if tex_node.reference:
         return tex_node.getRealNode().parsed
 
-    # Desc-based caching. It might misfire on multifile models, where the
-    # same desc means different things in different files.
-    # TODO: move caches to file level.
-    desc = tex_node.desc()
+    # Key-based caching, the key has the directory urls are relative to
+    desc = textureKey(tex_node, ancestry, node)
     if desc and desc in texture_cache:
         bpyima = texture_cache[desc]
         if tex_node.canHaveReferences():
@@ -2748,7 +3864,7 @@ def appearance_LoadTexture(tex_node, ancestry, node):
         repeat_t = tex_node.getFieldAsBool('repeatT', True, ancestry)
         bpyima.use_clamp_y = not repeat_t
 
-        # Update the desc-based cache
+        # Update the key-based cache
         if desc:
             texture_cache[desc] = bpyima
 
@@ -2759,7 +3875,11 @@ def appearance_LoadTexture(tex_node, ancestry, node):
     return bpyima
 
 
-def appearance_ExpandCachedMaterial(bpymat):
+def appearance_ExpandCachedMaterial(bpymat, is_vcol):
+    # The material may have been made for a shape without vertex colors
+    if is_vcol:
+        bpymat.use_vertex_color_paint = True
+
     if bpymat.texture_slots[0] is not None:
         bpyima = bpymat.texture_slots[0].texture.image
         tex_has_alpha = bpyima.use_alpha
@@ -2768,20 +3888,13 @@ def appearance_ExpandCachedMaterial(bpymat):
     return (bpymat, None, False)
 
 
-def appearance_MakeDescCacheKey(material, tex_node):
-    mat_desc = material.desc() if material else "Default"
-    tex_desc = tex_node.desc() if tex_node else "Default"
+def appearance_MakeCacheKey(material, tex_node, ancestry, node):
+    mat_desc = materialKey(material, ancestry) if material else "Default"
+    tex_desc = textureKey(tex_node, ancestry, node) if tex_node else "Default"
 
-    if not((tex_node and tex_desc is None) or
-           (material and mat_desc is None)):
-        # desc not available (in VRML)
-        # TODO: serialize VRML nodes!!!
-        return (mat_desc, tex_desc)
-    elif not tex_node and not material:
-        # Even for VRML, we cache the null material
-        return ("Default", "Default")
-    else:
-        return None  # Desc-based caching is off
+    if tex_desc is None:
+        return None  # A texture with no image, not worth caching
+    return (mat_desc, tex_desc)
 
 
 def appearance_Create(vrmlname, material, tex_node, ancestry, node, is_vcol):
@@ -2840,10 +3953,11 @@ def importShape_LoadAppearance(vrmlname, appr, ancestry, node, is_vcol):
     are entirely possible, too.
 
     Vertex coloring is not a part of appearance, but Blender
-    has a material flag for it. However, if a mesh has no vertex
-    color layer, setting use_vertex_color_paint to true has no
-    effect. So it's fine to reuse the same  material for  meshes
-    with vertex colors and for ones without.
+    has a material flag for it, and a cached material may have
+    been made for a shape without vertex colors. So on every
+    cache hit with is_vcol, use_vertex_color_paint is turned on.
+    If a mesh has no vertex color layer the flag has no effect,
+    so the material stays fine for the shapes without them.
     It's probably an abuse of Blender of some level.
 
     So here's the caching structure:
@@ -2855,14 +3969,14 @@ def importShape_LoadAppearance(vrmlname, appr, ancestry, node, is_vcol):
     For USE on material with no texture, we store the material object
     in the material node.
 
-    Also, we store textures by description in texture_cache.
+    Also, we store textures by textureKey() in texture_cache.
 
-    Also, we store materials by (material desc, texture desc)
-    in material_cache.
+    Also, we store materials by (materialKey(), textureKey())
+    in material_cache, for VRML and X3D alike.
     """
     # First, check entire-appearance cache
     if appr.reference:
-        return appearance_ExpandCachedMaterial(appr.getRealNode().parsed)
+        return appearance_ExpandCachedMaterial(appr.getRealNode().parsed, is_vcol)
 
     tex_node = appr.getChildBySpec(('ImageTexture', 'PixelTexture'))
     # Other texture nodes are: MovieTexture, MultiTexture
@@ -2871,10 +3985,10 @@ def importShape_LoadAppearance(vrmlname, appr, ancestry, node, is_vcol):
 
     # Check the USE-based material cache for textureless materials
     if material and material.reference and not tex_node and material.getRealNode().parsed:
-        return appearance_ExpandCachedMaterial(material.getRealNode().parsed)
+        return appearance_ExpandCachedMaterial(material.getRealNode().parsed, is_vcol)
 
-    # Now the description-based caching
-    cache_key = appearance_MakeDescCacheKey(material, tex_node)
+    # Now the field value based caching
+    cache_key = appearance_MakeCacheKey(material, tex_node, ancestry, node)
 
     if cache_key and cache_key in material_cache:
         bpymat = material_cache[cache_key]
@@ -2883,7 +3997,7 @@ def importShape_LoadAppearance(vrmlname, appr, ancestry, node, is_vcol):
             appr.parsed = bpymat
         if material and material.canHaveReferences() and not tex_node:
             material.parsed = bpymat
-        return appearance_ExpandCachedMaterial(bpymat)
+        return appearance_ExpandCachedMaterial(bpymat, is_vcol)
 
     # Done checking full-material caches. Texture cache may still kick in.
     # Create the material already
@@ -2903,31 +4017,25 @@ def importShape_LoadAppearance(vrmlname, appr, ancestry, node, is_vcol):
 
 
 def appearance_LoadPixelTexture(pixelTexture, ancestry):
-    image = pixelTexture.getFieldAsArray('image', 0, ancestry)
-    (w, h, plane_count) = image[0:3]
+    image = pixelTextureImage(pixelTexture, ancestry)
+    if image is None:
+        return None
+    (w, h, plane_count, pixels) = image
     has_alpha = plane_count in {2, 4}
-    pixels = image[3:]
     if len(pixels) != w * h:
         print("ImportX3D warning: pixel count in PixelTexture is off")
+        pixels = np.resize(pixels, w * h)  # repeats them, Blender needs them all
 
     bpyima = bpy.data.images.new("PixelTexture", w, h, has_alpha, True)
     bpyima.use_alpha = has_alpha
 
-    # Conditional above the loop, for performance
-    if plane_count == 3:  # RGB
-        bpyima.pixels = [(cco & 0xff) / 255 for pixel in pixels
-                         for cco in (pixel >> 16, pixel >> 8, pixel, 255)]
-    elif plane_count == 4:  # RGBA
-        bpyima.pixels = [(cco & 0xff) / 255 for pixel in pixels
-                         for cco
-                         in (pixel >> 24, pixel >> 16, pixel >> 8, pixel)]
-    elif plane_count == 1:  # Intensity - does Blender even support that?
-        bpyima.pixels = [(cco & 0xff) / 255 for pixel in pixels
-                         for cco in (pixel, pixel, pixel, 255)]
-    elif plane_count == 2:  # Intensity/aplha
-        bpyima.pixels = [(cco & 0xff) / 255 for pixel in pixels
-                         for cco
-                         in (pixel >> 8, pixel >> 8, pixel >> 8, pixel)]
+    rgba = pixelTextureRGBA(pixels, plane_count)
+    if rgba is not None:
+        if hasattr(bpyima.pixels, 'foreach_set'):
+            bpyima.pixels.foreach_set(rgba)
+        else:
+            # Older Blenders, a slice of python floats is the quickest there
+            bpyima.pixels[:] = rgba.tolist()
     bpyima.update()
     return bpyima
 
@@ -2936,6 +4044,15 @@ def appearance_LoadPixelTexture(pixelTexture, ancestry):
 def importShape_ProcessObject(vrmlname, bpydata, geom, geom_spec, node,
                               bpymat, has_alpha, texmtx, ancestry,
                               global_matrix):
+    importShape_ProcessData(vrmlname, bpydata, geom, geom_spec,
+                            bpymat, has_alpha, texmtx, ancestry)
+    importShape_LinkObject(vrmlname + geom_spec, bpydata, node, None,
+                           ancestry, global_matrix)
+
+
+# The object data side of importShape_ProcessObject, done once for shared meshes
+def importShape_ProcessData(vrmlname, bpydata, geom, geom_spec,
+                            bpymat, has_alpha, texmtx, ancestry):
     vrmlname += geom_spec
     bpydata.name = vrmlname
 
@@ -2970,12 +4087,212 @@ def importShape_ProcessObject(vrmlname, bpydata, geom, geom_spec, node,
         # Done transforming the texture
         # TODO: check if per-polygon textures are supported here.
 
+
+# mtx is applied before the transforms, eg: the size of a shared primitive
+def importShape_LinkObject(vrmlname, bpydata, node, mtx, ancestry, global_matrix):
     # Can transform data or object, better the object so we can instance
     # the data
     # bpymesh.transform(getFinalMatrix(node))
-    bpyob = node.blendObject = bpy.data.objects.new(vrmlname, bpydata)
-    bpyob.matrix_world = getFinalMatrix(node, None, ancestry, global_matrix)
-    bpy.context.scene.objects.link(bpyob)
+    queueObject(node, vrmlname, bpydata, getFinalMatrix(node, mtx, ancestry, global_matrix))
+
+
+def importShape_LoadPrimitive(vrmlname, geom, geom_spec, ancestry,
+                              bpymat, bpyima, has_alpha):
+    """
+    Sphere, Cylinder, Cone and Box meshes are made at unit size, once for
+    every primitiveKey() and appearance; CPK models have thousands of
+    atoms that only differ in size and place.
+    Returns the shared mesh, and the matrix that gives it its size.
+    """
+    key = primitiveKey(geom, ancestry) + (bpymat, bpyima)
+    bpymesh = primitive_cache.get(key)
+    if bpymesh is None:
+        bpymesh = geometry_importers[geom_spec](geom, ancestry, bpyima, True)
+        importShape_ProcessData(vrmlname, bpymesh, geom, geom_spec,
+                                bpymat, has_alpha, None, ancestry)
+        primitive_cache[key] = bpymesh
+
+    (sx, sy, sz) = primitiveSize(geom, ancestry)
+    mtx = Matrix(((sx, 0, 0, 0), (0, sy, 0, 0), (0, 0, sz, 0), (0, 0, 0, 1)))
+    return bpymesh, mtx
+
+
+def importShape_CanShareGeometry(geom, ancestry):
+    # DEF'd geometry is the same for every USE, unless it is in a PROTO
+    # body where IS fields may give each instance its own values.
+    return (geom.getRealNode().canHaveReferences() and
+            not any(node.getProtoName() for node in ancestry))
+
+
+def importShape_LoadDefinedGeometry(vrmlname, geom, geom_spec, ancestry,
+                                    bpymat, bpyima, has_alpha):
+    """
+    The mesh (or curve) of a DEF'd geometry node is made once and kept in
+    the node, like materials are; every USE under another Transform links
+    it to a new object. Appearances may differ between the uses, the
+    material and image are on the mesh, so there is one per combination.
+    """
+    geom_real = geom.getRealNode()
+    key = (bpymat, bpyima)
+    if geom_real.parsed is None:
+        geom_real.parsed = {}
+    elif key in geom_real.parsed:
+        return geom_real.parsed[key]
+
+    bpydata = geometry_importers[geom_spec](geom, ancestry, bpyima)
+    if bpydata is not None:
+        importShape_ProcessData(vrmlname, bpydata, geom, geom_spec,
+                                bpymat, has_alpha, None, ancestry)
+    geom_real.parsed[key] = bpydata
+    return bpydata
+
+
+class mergedMesh(object):
+    """
+    Collects the meshes of all shapes into one, in world space, for when
+    the separate objects would only be joined afterwards (print preparation).
+    Every shape adds its vertices, loops and polygons to growing buffers,
+    its material becomes the material index of its polygons. Texture
+    transforms and per shape smoothing are not applied in this mode.
+    """
+    __slots__ = ('co', 'vertex_index', 'loop_start', 'loop_total', 'material_index',
+                 'colors', 'uvs', 'images', 'materials', 'shared',
+                 'vertex_count', 'loop_count')
+
+    def __init__(self):
+        self.co = []
+        self.vertex_index = []
+        self.loop_start = []
+        self.loop_total = []
+        self.material_index = []
+        self.colors = []  # per loop, None for shapes without
+        self.uvs = []  # per loop, None for shapes without
+        self.images = []  # (image, polygon count) for the UV layer
+        self.materials = {}  # material -> index
+        self.shared = {}  # mesh -> its arrays, for meshes that are added many times
+        self.vertex_count = 0
+        self.loop_count = 0
+
+    def read(self, bpymesh):
+        """
+        The arrays of a mesh: co, vertex_index, loop_start, loop_total, colors and uvs.
+        """
+        nl = len(bpymesh.loops)
+        npoly = len(bpymesh.polygons)
+
+        co = np.zeros(len(bpymesh.vertices) * 3, dtype=np.float32)
+        bpymesh.vertices.foreach_get("co", co)
+        vertex_index = np.zeros(nl, dtype=np.int32)
+        bpymesh.loops.foreach_get("vertex_index", vertex_index)
+        loop_start = np.zeros(npoly, dtype=np.int32)
+        bpymesh.polygons.foreach_get("loop_start", loop_start)
+        loop_total = np.zeros(npoly, dtype=np.int32)
+        bpymesh.polygons.foreach_get("loop_total", loop_total)
+
+        colors = None
+        if bpymesh.vertex_colors:
+            colors = np.zeros(nl * 3, dtype=np.float32)
+            bpymesh.vertex_colors.active.data.foreach_get("color", colors)
+
+        uvs = None
+        if bpymesh.uv_layers:
+            uvs = np.zeros(nl * 2, dtype=np.float32)
+            bpymesh.uv_layers.active.data.foreach_get("uv", uvs)
+
+        return co.reshape(-1, 3), vertex_index, loop_start, loop_total, colors, uvs
+
+    def append(self, bpymesh, bpymat, bpyima, matrix, remove=True):
+        """
+        Adds a mesh, placed with the matrix. The mesh a geometry importer made
+        for this shape alone is removed afterwards; shared meshes (remove=False)
+        are read once and stamped as often as they are used.
+        """
+        if bpymesh in self.shared:
+            data = self.shared[bpymesh]
+        else:
+            data = self.read(bpymesh)
+            if remove:
+                bpy.data.meshes.remove(bpymesh)
+            else:
+                self.shared[bpymesh] = data
+        (co, vertex_index, loop_start, loop_total, colors, uvs) = data
+
+        mtx = np.array(matrix, dtype=np.float64)
+        co = np.dot(co, mtx[:3, :3].T) + mtx[:3, 3]
+        if np.linalg.det(mtx[:3, :3]) < 0:
+            # A mirroring matrix turns the polygons inside out, reverse the loops of each
+            offset = np.arange(loop_total.sum()) - np.repeat(np.cumsum(loop_total) - loop_total, loop_total)
+            order = np.arange(len(vertex_index))
+            order[np.repeat(loop_start, loop_total) + offset] = np.repeat(loop_start + loop_total - 1, loop_total) - offset
+            vertex_index = vertex_index[order]
+            if colors is not None:
+                colors = colors.reshape(-1, 3)[order].ravel()
+            if uvs is not None:
+                uvs = uvs.reshape(-1, 2)[order].ravel()
+        self.co.append(co.astype(np.float32))
+        self.vertex_index.append(vertex_index + self.vertex_count)
+        self.loop_start.append(loop_start + self.loop_count)
+        self.loop_total.append(loop_total)
+
+        if bpymat not in self.materials:
+            self.materials[bpymat] = len(self.materials)
+        self.material_index.append(np.full(len(loop_total), self.materials[bpymat], dtype=np.int32))
+
+        self.colors.append(colors)
+        self.uvs.append(uvs)
+        self.images.append((bpyima if uvs is not None else None, len(loop_total)))
+
+        self.vertex_count += len(co)
+        self.loop_count += len(vertex_index)
+
+    def finish(self, name):
+        """
+        Makes the one object, linked to the scene. Returns None if no shape was added.
+        """
+        if not self.co:
+            return None
+
+        loop_total = np.concatenate(self.loop_total)
+
+        bpymesh = bpy.data.meshes.new(name=name)
+        bpymesh.vertices.add(self.vertex_count)
+        bpymesh.vertices.foreach_set("co", np.concatenate(self.co).ravel())
+        bpymesh.loops.add(self.loop_count)
+        bpymesh.loops.foreach_set("vertex_index", np.concatenate(self.vertex_index))
+        bpymesh.polygons.add(len(loop_total))
+        bpymesh.polygons.foreach_set("loop_start", np.concatenate(self.loop_start))
+        bpymesh.polygons.foreach_set("loop_total", loop_total)
+        bpymesh.polygons.foreach_set("material_index", np.concatenate(self.material_index))
+        bpymesh.update(calc_edges=True)
+
+        for bpymat in sorted(self.materials, key=self.materials.get):
+            bpymesh.materials.append(bpymat)
+
+        def fill(chunks, size, value):
+            # Shapes without the layer get a neutral value
+            return np.concatenate([c if c is not None else np.full(len(v) * size, value, dtype=np.float32)
+                                   for c, v in zip(chunks, self.vertex_index)])
+
+        if any(c is not None for c in self.colors):
+            bpymesh.vertex_colors.new().data.foreach_set("color", fill(self.colors, 3, 1.0))
+
+        if any(c is not None for c in self.uvs):
+            d = bpymesh.uv_textures.new().data
+            images = [bpyima for bpyima, count in self.images for i in range(count)]
+            for f, bpyima in zip(d, images):
+                f.image = bpyima
+            bpymesh.uv_layers[0].data.foreach_set("uv", fill(self.uvs, 2, 0.0))
+
+        bpymesh.validate(False)
+        bpymesh.update()
+
+        for shared in self.shared:
+            bpy.data.meshes.remove(shared)
+        self.shared.clear()
+
+        bpyob = bpy.data.objects.new(name, bpymesh)
+        bpy.context.scene.objects.link(bpyob)
+        return bpyob
 
 
 # -----------------------------------------------------------------------------------
@@ -2999,8 +4316,11 @@ geometry_importers = {
     'Cylinder': importMesh_Cylinder,
     'Cone': importMesh_Cone}
 
+# Shared between shapes, see importShape_LoadPrimitive()
+primitive_specs = {'Sphere', 'Box', 'Cylinder', 'Cone'}
+
 
-def importShape(node, ancestry, global_matrix):
+def importShape(node, ancestry, global_matrix, merged=None, stats=NO_STATS):
     # Under Shape, we can only have Appearance, MetadataXXX and a geometry node
     def isGeometry(spec):
         return spec != "Appearance" and not spec.startswith("Metadata")
@@ -3023,10 +4343,11 @@ def importShape(node, ancestry, global_matrix):
     is_vcol = (geom.getChildBySpec(['Color', 'ColorRGBA']) is not None)
 
     if appr:
-        (bpymat, bpyima,
-         tex_has_alpha) = importShape_LoadAppearance(vrmlname, appr,
-                                                     ancestry, node,
-                                                     is_vcol)
+        with stats.phase('appearance'):
+            (bpymat, bpyima,
+             tex_has_alpha) = importShape_LoadAppearance(vrmlname, appr,
+                                                         ancestry, node,
+                                                         is_vcol)
 
         textx = appr.getChildBySpec('TextureTransform')
         if textx:
@@ -3038,13 +4359,39 @@ def importShape(node, ancestry, global_matrix):
     # ccw is handled by every geometry importer separately; some
     # geometries are easier to flip than others
     try:
-        bpydata = geometry_importers[geom_spec](geom, ancestry, bpyima)
+        with stats.phase(geom_spec):
+            # A texture transform is applied to the mesh, those can't be shared
+            if texmtx is None and (geom_spec in primitive_specs or
+                                   importShape_CanShareGeometry(geom, ancestry)):
+                if geom_spec in primitive_specs:
+                    bpydata, mtx = importShape_LoadPrimitive(vrmlname, geom, geom_spec, ancestry,
+                                                             bpymat, bpyima, tex_has_alpha)
+                else:
+                    bpydata = importShape_LoadDefinedGeometry(vrmlname, geom, geom_spec, ancestry,
+                                                              bpymat, bpyima, tex_has_alpha)
+                    mtx = None
+                    if bpydata is None:
+                        return
+
+                if merged is not None and type(bpydata) == bpy.types.Mesh:
+                    merged.append(bpydata, bpymat, bpyima,
+                                  getFinalMatrix(node, mtx, ancestry, global_matrix), False)
+                else:
+                    importShape_LinkObject(vrmlname + geom_spec, bpydata, node, mtx,
+                                           ancestry, global_matrix)
+                return
+
+            bpydata = geometry_importers[geom_spec](geom, ancestry, bpyima)
 
-        # There are no geometry importers that can legally return
-        # no object.  It's either a bpy object, or an exception
-        importShape_ProcessObject(vrmlname, bpydata, geom, geom_spec,
-                                  node, bpymat, tex_has_alpha, texmtx,
-                                  ancestry, global_matrix)
+            # There are no geometry importers that can legally return
+            # no object.  It's either a bpy object, or an exception
+            if merged is not None and type(bpydata) == bpy.types.Mesh:
+                merged.append(bpydata, bpymat, bpyima,
+                              getFinalMatrix(node, None, ancestry, global_matrix))
+            else:
+                importShape_ProcessObject(vrmlname, bpydata, geom, geom_spec,
+                                          node, bpymat, tex_has_alpha, texmtx,
+                                          ancestry, global_matrix)
     except KeyError:
         print('\tImportX3D warning: unsupported type "%s"' % geom_spec)
     # except Exception as exc:
@@ -3149,10 +4496,7 @@ def importLamp(node, spec, ancestry, global_matrix):
         print("Error, not a lamp")
         raise ValueError
 
-    bpyob = node.blendObject = bpy.data.objects.new("TODO", bpylamp)
-    bpy.context.scene.objects.link(bpyob).select = True
-
-    bpyob.matrix_world = getFinalMatrix(node, mtx, ancestry, global_matrix)
+    queueObject(node, "TODO", bpylamp, getFinalMatrix(node, mtx, ancestry, global_matrix), True)
 
 
 # -----------------------------------------------------------------------------------
@@ -3175,9 +4519,7 @@ def importViewpoint(node, ancestry, global_matrix):
 
     mtx = Matrix.Translation(Vector(position)) * translateRotation(orientation)
 
-    bpyob = node.blendObject = bpy.data.objects.new(name, bpycam)
-    bpy.context.scene.objects.link(bpyob).select = True
-    bpyob.matrix_world = getFinalMatrix(node, mtx, ancestry, global_matrix)
+    queueObject(node, name, bpycam, getFinalMatrix(node, mtx, ancestry, global_matrix), True)
 
 
 def importTransform(node, ancestry, global_matrix):
@@ -3185,14 +4527,54 @@ def importTransform(node, ancestry, global_matrix):
     if not name:
         name = 'Transform'
 
-    bpyob = node.blendObject = bpy.data.objects.new(name, None)
-    bpy.context.scene.objects.link(bpyob).select = True
+    # An empty, drawn as small axes by linkQueuedObjects so they are not too annoying
+    queueObject(node, name, None, getFinalMatrix(node, None, ancestry, global_matrix), True)
+
+
+# -----------------------------------------------------------------------------------
+# Objects are made and linked together once everything is imported, linking
+# them one at a time as each node was reached made big scenes slow to load.
+
 
-    bpyob.matrix_world = getFinalMatrix(node, None, ancestry, global_matrix)
+def queueObject(node, name, bpydata, matrix, select=False):
+    object_queue.append((node, name, bpydata, matrix, select))
 
-    # so they are not too annoying
-    bpyob.empty_draw_type = 'PLAIN_AXES'
-    bpyob.empty_draw_size = 0.2
+
+def linkQueuedObjects(scene, stats=NO_STATS):
+    """
+    Makes the objects for the queued nodes, then links them all into scene.
+    2.7x has no call that links many objects at once, so they are linked in
+    one loop after they are all made. Sets node.blendObject for each node,
+    a node used more than once keeps its last object.
+    """
+    new_object = bpy.data.objects.new
+    objects = []
+    meshes = set()
+    for node, name, bpydata, matrix, select in object_queue:
+        bpyob = node.blendObject = new_object(name, bpydata)
+        bpyob.matrix_world = matrix
+        if bpydata is None:
+            bpyob.empty_draw_type = 'PLAIN_AXES'
+            bpyob.empty_draw_size = 0.2
+        elif type(bpydata) == bpy.types.Mesh:
+            meshes.add(bpydata)
+        objects.append((bpyob, select))
+    del object_queue[:]
+
+    stats.count('objects', len(objects))
+    countMeshes(meshes, stats)
+
+    link = scene.objects.link
+    for bpyob, select in objects:
+        base = link(bpyob)
+        if select:
+            base.select = True
+
+
+def countMeshes(meshes, stats):
+    stats.count('meshes', len(meshes))
+    stats.count('vertices', sum(len(bpymesh.vertices) for bpymesh in meshes))
+    stats.count('faces', sum(len(bpymesh.polygons) for bpymesh in meshes))
 
 
 #def importTimeSensor(node):
@@ -3375,29 +4757,70 @@ def load_web3d(path,
                PREF_CIRCLE_DIV=16,
                global_matrix=None,
                HELPER_FUNC=None,
+               PREF_CACHE=False,
+               PREF_MERGE_DISTANCE=0.0,
+               PREF_MERGE_MESHES=False,
+               PREF_STATS=None,
                ):
+    """
+    PREF_CACHE: keep the parsed scene and converted GIF's in SCENE_CACHE_DIR,
+    so importing the same file again is quicker.
+    PREF_STATS: a file to append a JSON record of the import to, '-' to
+    print it, IMPORT_STATS_PATH when None.
+    """
+    stats = importStats()
+    if PREF_STATS is None:
+        PREF_STATS = IMPORT_STATS_PATH
 
     # Used when adding blender primitives
     GLOBALS['CIRCLE_DETAIL'] = PREF_CIRCLE_DIV
+    # Used by IndexedFaceSet, vertices closer than this are welded, 0 to keep them all
+    GLOBALS['MERGE_DISTANCE'] = PREF_MERGE_DISTANCE
+    # Used by the textures, converted GIF's are kept on disk
+    GLOBALS['CACHE'] = PREF_CACHE
+
+    root_node = None
+    if PREF_CACHE:
+        with stats.phase('cache load'):
+            root_node = sceneCacheLoad(path)
+    cached = stats.info['cached'] = root_node is not None
 
     #root_node = vrml_parse('/_Cylinder.wrl')
-    if path.lower().endswith('.x3d'):
-        root_node, msg = x3d_parse(path)
+    if cached:
+        msg = ''
+    elif path.lower().endswith('.x3d'):
+        root_node, msg = x3d_parse(path, stats)
     else:
-        root_node, msg = vrml_parse(path)
+        root_node, msg = vrml_parse(path, stats)
+
+    if root_node and path.lower().endswith('.x3d'):
+        bpy.ops.object.select_all(action='DESELECT')
 
     if not root_node:
         print(msg)
+        if PREF_STATS:
+            stats.info['error'] = msg
+            stats.write(path, PREF_STATS)
         return
 
     if global_matrix is None:
         global_matrix = Matrix()
 
+    # These hold Blender data, which can be gone by the next import.
+    # Converted GIF's are kept on disk, see textureCacheGet()
     texture_cache.clear()
     material_cache.clear()
+    primitive_cache.clear()
+    transform_cache.clear()
+    del object_queue[:]
 
     # fill with tuples - (node, [parents-parent, parent])
-    all_nodes = root_node.getSerialized([], [])
+    with stats.phase('serialize'):
+        all_nodes = root_node.getSerialized([], [])
+    stats.count('nodes', len(all_nodes))
+
+    # All the meshes go into one object, transforms are applied to the vertices
+    merged = mergedMesh() if PREF_MERGE_MESHES else None
 
     for node, ancestry in all_nodes:
         #if 'castle.wrl' not in node.getFilename():
@@ -3415,15 +4838,20 @@ def load_web3d(path,
             # by an external script. - gets first pick
             pass
         if spec == 'Shape':
-            importShape(node, ancestry, global_matrix)
+            # Only the time not spent on the appearance or the geometry is timed as Shape
+            with stats.phase(spec):
+                importShape(node, ancestry, global_matrix, merged, stats)
         elif spec in {'PointLight', 'DirectionalLight', 'SpotLight'}:
-            importLamp(node, spec, ancestry, global_matrix)
+            with stats.phase(spec):
+                importLamp(node, spec, ancestry, global_matrix)
         elif spec == 'Viewpoint':
-            importViewpoint(node, ancestry, global_matrix)
+            with stats.phase(spec):
+                importViewpoint(node, ancestry, global_matrix)
         elif spec == 'Transform':
             # Only use transform nodes when we are not importing a flat object hierarchy
-            if PREF_FLAT == False:
-                importTransform(node, ancestry, global_matrix)
+            if PREF_FLAT == False and merged is None:
+                with stats.phase(spec):
+                    importTransform(node, ancestry, global_matrix)
             '''
         # These are delt with later within importRoute
         elif spec=='PositionInterpolator':
@@ -3431,9 +4859,20 @@ def load_web3d(path,
             translatePositionInterpolator(node, action)
             '''
 
+    with stats.phase('link'):
+        linkQueuedObjects(bpy.context.scene, stats)
+
+    if merged is not None:
+        with stats.phase('merge'):
+            bpyob = merged.finish(bpy.path.display_name_from_filepath(path))
+        if bpyob is not None:
+            stats.count('objects')
+            countMeshes({bpyob.data}, stats)
+
     # After we import all nodes, route events - anim paths
-    for node, ancestry in all_nodes:
-        importRoute(node, ancestry)
+    with stats.phase('routes'):
+        for node, ancestry in all_nodes:
+            importRoute(node, ancestry)
 
     for node, ancestry in all_nodes:
         if node.isRoot():
@@ -3457,54 +4896,35 @@ def load_web3d(path,
 
     # Add in hierarchy
     if PREF_FLAT is False:
-        child_dict = {}
-        for node, ancestry in all_nodes:
-            if node.blendObject:
-                blendObject = None
-
-                # Get the last parent
-                i = len(ancestry)
-                while i:
-                    i -= 1
-                    blendObject = ancestry[i].blendObject
-                    if blendObject:
-                        break
-
-                if blendObject:
-                    # Parent Slow, - 1 liner but works
-                    # blendObject.makeParent([node.blendObject], 0, 1)
-
-                    # Parent FAST
-                    try:
-                        child_dict[blendObject].append(node.blendObject)
-                    except:
-                        child_dict[blendObject] = [node.blendObject]
+        with stats.phase('parent'):
+            for parent, children in parentMap(all_nodes).items():
+                for c in children:
+                    c.parent = parent
 
-        # Parent
-        for parent, children in child_dict.items():
-            for c in children:
-                c.parent = parent
-
-        # update deps
+    # update deps, once for all the new objects
+    with stats.phase('scene update'):
         bpy.context.scene.update()
-        del child_dict
 
+    # Now the arrays the import used are decoded, keep them for next time
+    if PREF_CACHE and not cached:
+        try:
+            with stats.phase('cache save'):
+                sceneCacheSave(path, root_node)
+        except (OSError, TypeError, ValueError) as e:
+            print('\tWarning, could not cache the parsed scene:', e)
 
-def loadWithProfiler(operator, context, filepath="", global_matrix=None):
-    import cProfile
-    import pstats
-    pro = cProfile.Profile()
-    pro.runctx("load_web3d(filepath,PREF_FLAT=True,"
-               "PREF_CIRCLE_DIV=16,global_matrix=global_matrix,)",
-               globals(), locals())
-    st = pstats.Stats(pro)
-    st.sort_stats("time")
-    st.print_stats(0.1)
-    # st.print_callers(0.1)
+    if PREF_STATS:
+        stats.write(path, PREF_STATS)
 
 
-def load(operator, context, filepath="", global_matrix=None):
-    # loadWithProfiler(operator, context, filepath, global_matrix)
+def load(operator, context, filepath="", global_matrix=None, stats_path=None, use_cache=False):
+    """
+    stats_path: a file to append a JSON record of the import's phase times
+    and counts to, '-' to print it. Defaults to the IMPORT_X3D_STATS variable.
+    use_cache: keep the parsed scene and converted GIF's in SCENE_CACHE_DIR for the
+    next import of the same file, off unless asked for.
+    """
     load_web3d(filepath, PREF_FLAT=True,
-               PREF_CIRCLE_DIV=16, global_matrix=global_matrix)
+               PREF_CIRCLE_DIV=16, global_matrix=global_matrix,
+               PREF_CACHE=use_cache, PREF_STATS=stats_path)
     return {'FINISHED'}